@@ -1,7 +1,47 @@
+from collections import namedtuple
 from decimal import Decimal
-from django.conf import settings
+from django.utils.functional import cached_property
 from shop.models import Product
-from coupons.models import Coupon
+from shop.cache import get_product_versions, get_products_stamp
+from coupons.cache import get_coupon
+from .forms import CartAddProductForm
+from .storage import CartUnavailable, get_cart_store, decode_cart, encode_cart, to_cents, from_cents
+
+
+class CartItem(namedtuple('CartItem', ['product', 'quantity', 'price', 'total_price'])):
+    '''Immutable line item of the cart.
+
+    Fields:
+        product: The Product object.
+        quantity: The quantity of the product in the cart.
+        price: Decimal unit price, the price of the product when it was added to the cart.
+        total_price: Decimal price of the line, the unit price times the quantity.
+    '''
+    __slots__ = ()
+
+    @property
+    def update_quantity_form(self):
+        '''Form to change the quantity of the line, with the current quantity as initial value.'''
+        return CartAddProductForm(initial={'quantity': self.quantity, 'override': True})
+
+
+class CartChange(namedtuple('CartChange', ['product_id', 'name', 'old_price', 'new_price'])):
+    '''Difference between a line of the cart and the catalog, found by Cart.reconcile.
+
+    Fields:
+        product_id: The ID of the product.
+        name: The name of the product, or None if the product no longer exists.
+        old_price: Decimal unit price of the line in the cart.
+        new_price: Decimal current price of the product, or None if the product is no
+            longer available and the line is removed.
+    '''
+    __slots__ = ()
+
+    @property
+    def removed(self):
+        '''True if the product is no longer available.'''
+        return self.new_price is None
+
 
 class Cart(object):
     '''Cart class to manage the shopping cart.'''
@@ -15,16 +55,27 @@ class Cart(object):
             None
         '''
         self.session = request.session
-        cart = self.session.get(settings.CART_SESSION_ID)
-        if not cart:
-            #save an empty cart in the session
-            cart = self.session[settings.CART_SESSION_ID] = {}
-
-        #a cart is a dictionary with product ID's as keys, for each product ID, the value is
-        # a dictionary which includes quantity and price key-value pairs
-        self.cart = cart
+        # the storage of the cart, selected with the CART_STORE setting
+        self.store = get_cart_store(self.session)
+        # an empty cart is only saved once a product is added, so that visitors who never
+        # use the cart do not cause writes
+        self.data = self.store.load() or encode_cart({})
+        # the lines of the cart, a dictionary with product ID's as keys and [quantity, price
+        # in cents] lists as values, decoded from the stored data when first needed
+        self._cart = None
         # store current applied coupon
         self.coupon_id = self.session.get('coupon_id')
+        # line items and discount, computed once and reused until the cart changes
+        self._items = None
+        self._discount = None
+
+
+    @property
+    def cart(self):
+        '''The lines of the cart, decoded from the stored data on first access.'''
+        if self._cart is None:
+            self._cart = decode_cart(self.data)
+        return self._cart
 
 
     def add(self, product, quantity=1, override_quantity=False):
@@ -40,19 +91,18 @@ class Cart(object):
         Returns:
             None
         '''
-        product_id = str(product.id)
-        if product_id not in self.cart:
-            self.cart[product_id] = {'quantity': 0, 'price': str(product.price)}
-
-        if override_quantity:
-            self.cart[product_id]['quantity'] = quantity
-        else:
-            self.cart[product_id]['quantity'] += quantity
-        self.save()
+        self.data = self.store.add(
+            product.id,
+            quantity,
+            to_cents(product.price),
+            override_quantity=override_quantity
+        )
+        self.reset()
         
 
     def save(self):
-        '''Mark the session as 'modified' to make sure it gets saved.
+        '''Store the lines of the cart (the cart attribute) with the cart store. The line
+        items and discount computed for the previous contents of the cart are discarded.
         
         Args:
             None
@@ -60,7 +110,15 @@ class Cart(object):
         Returns:
             None
         '''
-        self.session.modified = True
+        self.data = self.store.save(self.cart)
+        self.reset()
+
+
+    def reset(self):
+        '''Discard the decoded lines, line items and discount computed for the cart.'''
+        self._cart = None
+        self._items = None
+        self._discount = None
 
 
     def remove(self, product):
@@ -72,67 +130,162 @@ class Cart(object):
         Returns:
             None
         '''
-        product_id = str(product.id)
-        if product_id in self.cart:
-            del self.cart[product_id]
-            self.save()
+        self.data = self.store.remove(product.id)
+        self.reset()
         
 
+    def get_items(self):
+        '''Return the line items of the cart, getting all the products from the database
+        with a single query the first time it is called.
+
+        The line items are built from copies of the stored data, so the stored cart is never
+        mutated, and are reused by later calls until the cart changes. Lines of products
+        which no longer exist are removed from the cart, so that the number of items and
+        the total price match the line items.
+
+        Returns:
+            Tuple of CartItem objects.
+        '''
+        if self._items is None:
+            # get the product objects of the cart
+            products = Product.objects.in_bulk(list(self.cart.keys()))
+            missing = [product_id for product_id in self.cart if product_id not in products]
+            if missing:
+                try:
+                    # only the missing lines are removed, the lines changed by a concurrent
+                    # request are kept, and the stored totals are updated
+                    self.data = self.store.remove_many(missing)
+                except CartUnavailable:
+                    # the lines are removed the next time the cart is loaded
+                    self.data = encode_cart({
+                        id: line for id, line in self.cart.items() if id not in missing
+                    })
+                self._cart = None
+                self._discount = None
+            items = []
+            for product_id, (quantity, cents) in self.cart.items():
+                product = products.get(product_id)
+                if product is None:
+                    # added by a concurrent request since the products were read
+                    continue
+                # note the product price is the same as the first time the user added it to the cart
+                # the price is not subsequently updated, regardless of updates in the database.
+                price = from_cents(cents)
+                items.append(CartItem(product, quantity, price, price * quantity))
+            self._items = tuple(items)
+        return self._items
+
+
     def __iter__(self):
-        '''Iterate over the items in the cart and get the products from the database.'''
-        product_ids = self.cart.keys()
-        # get the product objects and add them to the cart
-        products = Product.objects.filter(id__in=product_ids)
-
-        cart = self.cart.copy()
-        for product in products:
-            # add the product instance to the cart
-            cart[str(product.id)]['product'] = product
-        
-        for item in cart.values():
-            # note the product price is the same as the first time the user added it to the cart
-            # the price is not subsequently updated, regardless of updates in the database.
-            item['price'] = Decimal(item['price'])
-            item['total_price'] = item['price'] * item['quantity']
-            yield item
+        '''Iterate over the line items of the cart, see get_items.'''
+        return iter(self.get_items())
         
 
     def __len__(self):
-        '''Count all items in the cart and return an integer.'''
-        return sum(item['quantity'] for item in self.cart.values())
+        '''Count all items in the cart and return an integer, read from the stored totals.'''
+        return self.data['n']
 
 
     def get_total_price(self):
-        '''Return the total cost of the cart.'''
-        return sum(Decimal(item['price']) * item['quantity'] for item in self.cart.values())
+        '''Return the total cost of the cart, read from the stored totals.'''
+        return from_cents(self.data['t'])
 
 
     def clear(self):
-        '''Remove the cart from the session.'''
-        del self.session[settings.CART_SESSION_ID]
-        self.save()
+        '''Remove the cart from the cart store.'''
+        self.store.clear()
+        self.data = encode_cart({})
+        self.reset()
 
 
-    @property
+    def reconcile(self, apply=True, force=False):
+        '''Compare the lines of the cart with the current price and availability of their
+        products, with a single query.
+
+        The stamp of the versions of the products in the cart is stored with the cart
+        once it has been reconciled, so the query is skipped until one of the products
+        is changed or the products in the cart change, see shop.cache.get_product_versions.
+
+        Args:
+            apply (bool): Whether to update the prices of the lines and remove the lines
+                of unavailable products (True), or only report the differences (False).
+            force (bool): Whether to compare the lines even if the stamp is unchanged,
+                e.g. before placing an order. Defaults to False.
+
+        Returns:
+            List of CartChange objects, empty if the cart matches the catalog.
+        '''
+        if self.is_empty:
+            return []
+        # the versions are read before the products, so a product changed in between is
+        # checked again next time
+        versions = get_product_versions(self.data['ids'])
+        if not force and versions is not None and self.data.get('s') == get_products_stamp(versions):
+            return []
+
+        products = {
+            id: (name, price, available) for id, name, price, available in
+            Product.objects.filter(id__in=self.data['ids']).values_list('id', 'name', 'price', 'available')
+        }
+        changes = []
+        for product_id, (quantity, cents) in self.cart.items():
+            name, price, available = products.get(product_id, (None, None, False))
+            if not available:
+                changes.append(CartChange(product_id, name, from_cents(cents), None))
+            elif to_cents(price) != cents:
+                changes.append(CartChange(product_id, name, from_cents(cents), price))
+        if not apply:
+            return changes
+
+        if changes:
+            # only the changed lines are written, so that the lines added or removed by
+            # a concurrent request, e.g. in another browser tab, are kept
+            removed = [change.product_id for change in changes if change.removed]
+            prices = {
+                change.product_id: to_cents(change.new_price)
+                for change in changes if not change.removed
+            }
+            try:
+                if removed:
+                    self.data = self.store.remove_many(removed)
+                if prices:
+                    self.data = self.store.set_prices(prices)
+            except CartUnavailable:
+                # the changes are reported, and the cart is checked again next time
+                return changes
+            finally:
+                self.reset()
+        if versions is not None and set(self.cart) <= set(versions):
+            # the stamp of the products left in the cart, unless a concurrent request
+            # added a product that was not checked
+            stamp = get_products_stamp({id: versions[id] for id in self.cart})
+            self.store.set_stamp(stamp)
+            self.data['s'] = stamp
+        return changes
+
+
+    @cached_property
     def coupon(self):
-        '''The method is defined as an attribute by use of the property
-        decorator. If the coupon_id is an attribute of the cart, then
-        the Coupon object with the corresponding ID is returned.
+        '''The method is defined as an attribute by use of the cached_property
+        decorator, so the coupon is only looked up once per cart. If the coupon_id
+        is an attribute of the cart, then the Coupon object with the corresponding
+        ID is returned, from the coupon cache.
         '''
         if self.coupon_id:
-            try:
-                return Coupon.objects.get(id=self.coupon_id)
-            except Coupon.DoesNotExist:
-                pass
+            return get_coupon(self.coupon_id)
         return None
     
 
     def get_discount(self):
         '''Method that retrieves the discount rate, if the cart contains a coupon,
         and returns the amount to be deducted from the total amount of the cart.'''
-        if self.coupon:
-            return (self.coupon.discount / Decimal(100)) * self.get_total_price()
-        return Decimal(0)
+        if self._discount is None:
+            coupon = self.coupon
+            if coupon:
+                self._discount = (coupon.discount / Decimal(100)) * self.get_total_price()
+            else:
+                self._discount = Decimal(0)
+        return self._discount
     
 
     def get_total_price_after_discount(self):
@@ -143,4 +296,19 @@ class Cart(object):
     @property
     def is_empty(self):
         '''Returns True if the len of the cart is 0, else returns False.'''
-        return self.cart.__len__()==0
+        return len(self.data['ids'])==0
+
+
+def get_cart(request):
+    '''Return the cart of the request, creating it on first use, so that the view and
+    the templates rendered for a request share one Cart and its computed line items.
+
+    Args:
+        request: A http request object.
+
+    Returns:
+        A Cart object.
+    '''
+    if not hasattr(request, '_cart'):
+        request._cart = Cart(request)
+    return request._cart
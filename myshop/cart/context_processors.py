@@ -1,5 +1,10 @@
-from .cart import Cart
+from django.utils.functional import SimpleLazyObject
+from .cart import get_cart
 
 def cart(request):
-    '''Instantiate the cart using the request object and make it available to all templates.'''
-    return {'cart':Cart(request)}
\ No newline at end of file
+    '''Make the cart of the request available to all templates.
+
+    The cart is wrapped in a lazy object, so the session is only read, and the database
+    only queried, when a template actually uses the cart. The item count and the total
+    price shown in the header are computed from the session data, without any query.'''
+    return {'cart':SimpleLazyObject(lambda: get_cart(request))}
\ No newline at end of file
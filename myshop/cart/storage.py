@@ -0,0 +1,395 @@
+import logging
+import uuid
+from contextlib import contextmanager
+from decimal import Decimal
+import redis
+from django.conf import settings
+from django.utils.module_loading import import_string
+from shop.backends import get_redis, run_script
+
+logger = logging.getLogger(__name__)
+
+# version of the format of the cart stored in the session, see encode_cart
+CART_FORMAT_VERSION = 2
+
+
+class CartUnavailable(Exception):
+    '''Raised when the cart store cannot change a cart, e.g. when Redis is unavailable.'''
+
+
+# Lua script setting the prices of the lines of a cart hash that are still in the cart,
+# so that a line removed by a concurrent request is not brought back.
+# KEYS[1]: the cart hash.
+# ARGV: pairs of product ID and price in cents.
+SET_PRICES_SCRIPT = '''
+for i = 1, #ARGV, 2 do
+    if redis.call('HEXISTS', KEYS[1], 'q:' .. ARGV[i]) == 1 then
+        redis.call('HSET', KEYS[1], 'c:' .. ARGV[i], ARGV[i + 1])
+    end
+end
+return redis.call('HGETALL', KEYS[1])
+'''
+
+
+def to_cents(price):
+    '''Convert a Decimal price to an integer number of cents.'''
+    return int((Decimal(price) * 100).to_integral_value())
+
+
+def from_cents(cents):
+    '''Convert an integer number of cents to a Decimal price with two decimal places.'''
+    return Decimal(cents).scaleb(-2)
+
+
+def encode_cart(cart):
+    '''Encode the lines of a cart in the compact format stored in the session.
+
+    The product ID's, quantities and prices in cents are stored in parallel arrays,
+    together with the number of items and the total price in cents, so the size of the
+    cart and its total can be read without decoding the lines.
+
+    Args:
+        cart (dict): Dictionary with product ID's as keys and [quantity, price in cents]
+            lists as values.
+
+    Returns:
+        Dictionary with the keys v (format version), ids, q (quantities), c (prices in
+        cents), n (number of items) and t (total price in cents).
+    '''
+    ids = list(cart.keys())
+    quantities = [cart[id][0] for id in ids]
+    cents = [cart[id][1] for id in ids]
+    return {
+        'v': CART_FORMAT_VERSION,
+        'ids': ids,
+        'q': quantities,
+        'c': cents,
+        'n': sum(quantities),
+        't': sum(q * c for q, c in zip(quantities, cents)),
+    }
+
+
+def decode_cart(data):
+    '''Decode the lines of a cart stored in the session, see encode_cart.
+
+    Args:
+        data (dict): The encoded cart.
+
+    Returns:
+        Dictionary with product ID's as keys and [quantity, price in cents] lists as values.
+    '''
+    return {id: [q, c] for id, q, c in zip(data['ids'], data['q'], data['c'])}
+
+
+def decode_legacy_cart(data):
+    '''Decode a cart stored in the previous format, a dictionary with string product
+    ID's as keys and {'quantity': n, 'price': 'decimal string'} dictionaries as values.
+
+    Args:
+        data (dict): The cart in the previous format.
+
+    Returns:
+        Dictionary with product ID's as keys and [quantity, price in cents] lists as values.
+    '''
+    return {
+        int(id): [item['quantity'], to_cents(item['price'])]
+        for id, item in data.items()
+    }
+
+
+class BaseCartStore(object):
+    '''Interface of the storage of the carts.
+
+    The lines of a cart are passed around as dictionaries with product ID's as keys
+    and [quantity, price in cents] lists as values. The methods that change a cart
+    return the changed cart encoded with encode_cart, so that the Cart does not need
+    to load it again. The methods that change a cart raise CartUnavailable if the
+    storage fails.
+    '''
+
+    def __init__(self, session):
+        '''Initialize the store.
+
+        Args:
+            session: The session of the request the cart belongs to.
+
+        Returns:
+            None
+        '''
+        self.session = session
+
+    def load(self):
+        '''Return the cart encoded with encode_cart, or None if there is no cart.'''
+        raise NotImplementedError
+
+    def add(self, product_id, quantity, cents, override_quantity=False):
+        '''Add a product to the cart or update its quantity.
+
+        Args:
+            product_id (int): The ID of the product.
+            quantity (int): The quantity to add, or to set if override_quantity is True.
+            cents (int): The price of the product in cents, which is only stored when the
+                product is not in the cart yet.
+            override_quantity (bool): Whether to replace the quantity instead of adding to it.
+
+        Returns:
+            The encoded cart.
+        '''
+        raise NotImplementedError
+
+    def remove(self, product_id):
+        '''Remove a product from the cart and return the encoded cart.'''
+        raise NotImplementedError
+
+    def remove_many(self, product_ids):
+        '''Remove the given products from the cart and return the encoded cart, leaving
+        the other lines as they are stored.'''
+        raise NotImplementedError
+
+    def set_prices(self, prices):
+        '''Set the prices of lines of the cart and return the encoded cart, leaving the
+        other lines as they are stored.
+
+        Args:
+            prices (dict): Dictionary with product ID's as keys and prices in cents as
+                values. The products no longer in the cart are ignored.
+
+        Returns:
+            The encoded cart.
+        '''
+        raise NotImplementedError
+
+    def save(self, cart):
+        '''Replace the lines of the cart and return the encoded cart.'''
+        raise NotImplementedError
+
+    def clear(self):
+        '''Remove the cart.'''
+        raise NotImplementedError
+
+    def set_stamp(self, stamp):
+        '''Store the stamp of the products the cart was last reconciled with, as the s
+        key of the encoded cart, see Cart.reconcile.'''
+        raise NotImplementedError
+
+
+class SessionCartStore(BaseCartStore):
+    '''Cart store keeping the whole cart in the session, encoded with encode_cart.
+
+    Every change of the cart rewrites the cart in the session. Carts stored in the
+    previous format are converted the first time they are loaded.
+    '''
+
+    def load(self):
+        data = self.session.get(settings.CART_SESSION_ID)
+        if not isinstance(data, dict):
+            # no cart, or the key of a cart stored by the RedisCartStore
+            return None
+        if data and data.get('v') != CART_FORMAT_VERSION:
+            # migrate a cart stored in the previous format
+            data = self.save(decode_legacy_cart(data))
+        return data or None
+
+    def add(self, product_id, quantity, cents, override_quantity=False):
+        data = self.load()
+        cart = decode_cart(data) if data else {}
+        if product_id not in cart:
+            cart[product_id] = [0, cents]
+        if override_quantity:
+            cart[product_id][0] = quantity
+        else:
+            cart[product_id][0] += quantity
+        return self.save(cart)
+
+    def remove(self, product_id):
+        data = self.load()
+        cart = decode_cart(data) if data else {}
+        if product_id not in cart:
+            return data or encode_cart(cart)
+        del cart[product_id]
+        return self.save(cart)
+
+    def remove_many(self, product_ids):
+        data = self.load()
+        cart = decode_cart(data) if data else {}
+        for product_id in product_ids:
+            cart.pop(product_id, None)
+        return self.save(cart)
+
+    def set_prices(self, prices):
+        data = self.load()
+        cart = decode_cart(data) if data else {}
+        for product_id, cents in prices.items():
+            if product_id in cart:
+                cart[product_id][1] = cents
+        return self.save(cart)
+
+    def save(self, cart):
+        data = encode_cart(cart)
+        self.session[settings.CART_SESSION_ID] = data
+        self.session.modified = True
+        return data
+
+    def clear(self):
+        self.session.pop(settings.CART_SESSION_ID, None)
+        self.session.modified = True
+
+    def set_stamp(self, stamp):
+        data = self.load()
+        if data:
+            data['s'] = stamp
+            self.session.modified = True
+
+
+class RedisCartStore(BaseCartStore):
+    '''Cart store keeping each cart as a Redis hash, with a quantity and a price field
+    per product. The session only holds the key of the cart, which is written once when
+    the first product is added.
+
+    Quantities are changed with HINCRBY and the price with HSETNX in a transaction,
+    lines are removed with HDEL and reconciled prices are set with a script that skips
+    the lines removed meanwhile, so concurrent requests for the same cart, e.g. from two
+    browser tabs, do not overwrite each other's changes. The hash expires CART_REDIS_TIMEOUT seconds after the last
+    change of the cart.
+
+    The carts are read and written with the Redis client of the requests and its short
+    timeout. When Redis fails, a cart is read as empty and a change of the cart raises
+    CartUnavailable.
+    '''
+
+    @contextmanager
+    def changing(self):
+        '''Context manager raising CartUnavailable for the errors of Redis.'''
+        try:
+            yield
+        except redis.RedisError as e:
+            logger.warning('Could not change the cart.', exc_info=True)
+            raise CartUnavailable('The cart is temporarily unavailable.') from e
+
+    def get_key(self, create=False):
+        '''Return the Redis key of the cart, or None if the session has no cart. With
+        create=True a cart key is generated and stored in the session if there is none.'''
+        cart_id = self.session.get(settings.CART_SESSION_ID)
+        if not isinstance(cart_id, str):
+            # no cart, or a cart stored in the session by the SessionCartStore
+            if not create:
+                return None
+            cart_id = uuid.uuid4().hex
+            self.session[settings.CART_SESSION_ID] = cart_id
+            self.session.modified = True
+        return f'cart:{cart_id}'
+
+    def get_timeout(self):
+        return getattr(settings, 'CART_REDIS_TIMEOUT', 60 * 60 * 24 * 14)
+
+    def decode(self, fields):
+        '''Encode the cart from the fields of its hash, in the order of the product ID's.'''
+        cart = {}
+        stamp = None
+        for field, value in fields.items():
+            if field == b's':
+                stamp = value.decode()
+                continue
+            kind, product_id = field.decode().split(':')
+            line = cart.setdefault(int(product_id), [0, 0])
+            line[0 if kind == 'q' else 1] = int(value)
+        data = encode_cart(dict(sorted(cart.items())))
+        if stamp is not None:
+            data['s'] = stamp
+        return data
+
+    def load(self):
+        key = self.get_key()
+        if key is None:
+            return None
+        try:
+            fields = get_redis().hgetall(key)
+        except redis.RedisError:
+            logger.warning('Could not read the cart, it is shown as empty.', exc_info=True)
+            return None
+        return self.decode(fields) if fields else None
+
+    def add(self, product_id, quantity, cents, override_quantity=False):
+        key = self.get_key(create=True)
+        with self.changing(), get_redis().pipeline() as pipe:
+            # the price is only stored when the product is not in the cart yet
+            pipe.hsetnx(key, f'c:{product_id}', cents)
+            if override_quantity:
+                pipe.hset(key, f'q:{product_id}', quantity)
+            else:
+                pipe.hincrby(key, f'q:{product_id}', quantity)
+            pipe.expire(key, self.get_timeout())
+            pipe.hgetall(key)
+            return self.decode(pipe.execute()[-1])
+
+    def remove(self, product_id):
+        key = self.get_key()
+        if key is None:
+            return encode_cart({})
+        with self.changing(), get_redis().pipeline() as pipe:
+            pipe.hdel(key, f'q:{product_id}', f'c:{product_id}')
+            pipe.hgetall(key)
+            return self.decode(pipe.execute()[-1])
+
+    def remove_many(self, product_ids):
+        key = self.get_key()
+        if key is None:
+            return encode_cart({})
+        fields = [f'{kind}:{product_id}' for product_id in product_ids for kind in 'qc']
+        with self.changing(), get_redis().pipeline() as pipe:
+            if fields:
+                pipe.hdel(key, *fields)
+            pipe.hgetall(key)
+            return self.decode(pipe.execute()[-1])
+
+    def set_prices(self, prices):
+        key = self.get_key()
+        if key is None:
+            return encode_cart({})
+        args = [value for product_id, cents in prices.items() for value in (product_id, cents)]
+        with self.changing():
+            fields = run_script(SET_PRICES_SCRIPT, keys=[key], args=args)
+        # HGETALL returns a flat list of fields and values to Lua scripts
+        return self.decode(dict(zip(fields[::2], fields[1::2])))
+
+    def save(self, cart):
+        key = self.get_key(create=True)
+        with self.changing(), get_redis().pipeline() as pipe:
+            pipe.delete(key)
+            if cart:
+                mapping = {}
+                for product_id, (quantity, cents) in cart.items():
+                    mapping[f'q:{product_id}'] = quantity
+                    mapping[f'c:{product_id}'] = cents
+                pipe.hset(key, mapping=mapping)
+                pipe.expire(key, self.get_timeout())
+            pipe.execute()
+        return encode_cart(cart)
+
+    def clear(self):
+        key = self.get_key()
+        if key is not None:
+            try:
+                get_redis().delete(key)
+            except redis.RedisError:
+                # the cart expires after CART_REDIS_TIMEOUT seconds
+                logger.warning('Could not clear the cart.', exc_info=True)
+
+    def set_stamp(self, stamp):
+        key = self.get_key()
+        if key is not None:
+            try:
+                with get_redis().pipeline() as pipe:
+                    pipe.hset(key, 's', stamp)
+                    pipe.expire(key, self.get_timeout())
+                    pipe.execute()
+            except redis.RedisError:
+                # the cart is checked again next time
+                logger.warning('Could not store the stamp of the cart.', exc_info=True)
+
+
+def get_cart_store(session):
+    '''Function returning the cart store of the CART_STORE setting, a dotted path to a
+    BaseCartStore subclass, for the given session.'''
+    path = getattr(settings, 'CART_STORE', 'cart.storage.SessionCartStore')
+    return import_string(path)(session)
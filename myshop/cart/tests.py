@@ -1,3 +1,161 @@
-from django.test import TestCase
+from decimal import Decimal
+from unittest import mock, skipIf
+import redis
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import RequestFactory, TestCase, override_settings
+from shop.models import Category, Product
+from .cart import Cart
+from .storage import CartUnavailable
 
-# Create your tests here.
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class CartTestCase(TestCase):
+    '''Base class of the tests of the Cart, with the versions of the products kept in a
+    fake Redis.'''
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch('shop.backends._client', self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        category = Category.objects.create(name='Tea', slug='tea')
+        self.product = Product.objects.create(category=category, name='Green tea', slug='green-tea', price=Decimal('10.00'))
+        self.request = RequestFactory().get('/cart/')
+        self.request.session = SessionStore()
+
+    def get_cart(self):
+        return Cart(self.request)
+
+
+class CartItemsTests(CartTestCase):
+    '''Tests of the line items and totals of the Cart.'''
+
+    def test_totals(self):
+        cart = self.get_cart()
+        cart.add(self.product, quantity=2)
+        self.assertEqual(len(cart), 2)
+        self.assertEqual(cart.get_total_price(), Decimal('20.00'))
+        self.assertEqual([item.total_price for item in cart], [Decimal('20.00')])
+
+    def test_cart_key_of_another_store_is_ignored(self):
+        # the key of a cart stored by the RedisCartStore, before CART_STORE was changed
+        self.request.session[settings.CART_SESSION_ID] = 'cart-key'
+        cart = self.get_cart()
+        self.assertTrue(cart.is_empty)
+        cart.add(self.product)
+        self.assertEqual(len(self.get_cart()), 1)
+
+    def test_deleted_product_is_removed(self):
+        other = Product.objects.create(category=self.product.category, name='Black tea', slug='black-tea', price=Decimal('5.00'))
+        cart = self.get_cart()
+        cart.add(self.product, quantity=2)
+        cart.add(other)
+        other.delete()
+        cart = self.get_cart()
+        items = cart.get_items()
+        self.assertEqual([item.product for item in items], [self.product])
+        self.assertEqual(len(cart), sum(item.quantity for item in items))
+        self.assertEqual(cart.get_total_price(), sum(item.total_price for item in items))
+        # the line of the deleted product is removed from the stored cart
+        self.assertEqual(self.get_cart().data['ids'], [self.product.id])
+
+
+@override_settings(CART_STORE='cart.storage.RedisCartStore')
+class RedisCartStoreTests(CartTestCase):
+    '''Tests of the Cart stored in a fake Redis.'''
+
+    def test_add(self):
+        self.get_cart().add(self.product, quantity=2)
+        self.get_cart().add(self.product)
+        cart = self.get_cart()
+        self.assertEqual(len(cart), 3)
+        self.assertEqual(cart.get_total_price(), Decimal('30.00'))
+
+    def test_cart_is_empty_when_redis_is_unavailable(self):
+        self.get_cart().add(self.product)
+        with mock.patch.object(self.redis, 'hgetall', side_effect=redis.ConnectionError):
+            cart = self.get_cart()
+        self.assertTrue(cart.is_empty)
+        self.assertEqual(len(cart), 0)
+
+    def test_change_fails_when_redis_is_unavailable(self):
+        cart = self.get_cart()
+        with mock.patch.object(self.redis, 'pipeline', side_effect=redis.ConnectionError):
+            with self.assertRaises(CartUnavailable):
+                cart.add(self.product)
+
+    def test_reconcile_keeps_lines_added_concurrently(self):
+        self.get_cart().add(self.product)
+        cart = self.get_cart()
+        cart.cart
+        self.product.price = Decimal('99.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        # another browser tab adds a product after the cart was loaded
+        other = Product.objects.create(category=self.product.category, name='Black tea', slug='black-tea', price=Decimal('5.00'))
+        self.get_cart().add(other)
+        self.assertEqual(len(cart.reconcile()), 1)
+        self.assertEqual(self.get_cart().get_total_price(), Decimal('104.00'))
+
+
+class CartReconcileTests(CartTestCase):
+    '''Tests of Cart.reconcile.'''
+
+    def test_unchanged_cart_is_not_checked_again(self):
+        cart = self.get_cart()
+        cart.add(self.product)
+        self.assertEqual(cart.reconcile(), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_cart().reconcile(), [])
+
+    def test_price_change_is_reported(self):
+        cart = self.get_cart()
+        cart.add(self.product)
+        cart.reconcile()
+        self.product.price = Decimal('99.00')
+        # the version is bumped once the change is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        changes = self.get_cart().reconcile()
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0].new_price, Decimal('99.00'))
+        self.assertEqual(self.get_cart().get_total_price(), Decimal('99.00'))
+
+    def test_price_change_is_reported_after_versions_are_evicted(self):
+        cart = self.get_cart()
+        cart.add(self.product)
+        cart.reconcile()
+        self.product.price = Decimal('99.00')
+        # the version is bumped once the change is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        # the versions are lost, e.g. evicted by Redis
+        self.redis.flushdb()
+        changes = self.get_cart().reconcile()
+        self.assertEqual([change.new_price for change in changes], [Decimal('99.00')])
+        self.assertEqual(self.get_cart().data['c'], [9900])
+
+    def test_price_change_is_reported_when_redis_is_unavailable(self):
+        cart = self.get_cart()
+        cart.add(self.product)
+        cart.reconcile()
+        Product.objects.filter(id=self.product.id).update(price=Decimal('99.00'))
+        with mock.patch.object(self.redis, 'mget', side_effect=redis.ConnectionError):
+            changes = self.get_cart().reconcile()
+        self.assertEqual([change.new_price for change in changes], [Decimal('99.00')])
+
+    def test_forced_check_finds_changes_the_versions_missed(self):
+        cart = self.get_cart()
+        cart.add(self.product)
+        cart.reconcile()
+        # QuerySet.update() does not send the signals that bump the versions
+        Product.objects.filter(id=self.product.id).update(price=Decimal('99.00'))
+        self.assertEqual(self.get_cart().reconcile(), [])
+        changes = self.get_cart().reconcile(force=True)
+        self.assertEqual([change.new_price for change in changes], [Decimal('99.00')])
@@ -1,8 +1,10 @@
+from django.contrib import messages
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils.translation import override
 from django.views.decorators.http import require_POST
 from shop.models import Product
-from .cart import Cart
+from .cart import get_cart
+from .storage import CartUnavailable
 from .forms import CartAddProductForm
 from coupons.forms import CouponApplyForm
 from shop.recommender import Recommender
@@ -20,16 +22,19 @@ def cart_add(request, product_id):
         Redirects to the cart detail URL, which will display all the contents
         of the cart.
     '''
-    cart = Cart(request)
+    cart = get_cart(request)
     product = get_object_or_404(Product, id = product_id)
     form = CartAddProductForm(request.POST)
     if form.is_valid():
         cd = form.cleaned_data
-        cart.add(
-            product=product,
-            quantity=cd['quantity'],
-            override_quantity=cd['override']
-        )
+        try:
+            cart.add(
+                product=product,
+                quantity=cd['quantity'],
+                override_quantity=cd['override']
+            )
+        except CartUnavailable:
+            messages.error(request, 'Your cart is temporarily unavailable, please try again.')
     return redirect('cart:cart_detail')
 
 
@@ -45,23 +50,26 @@ def cart_remove(request, product_id):
         Redirects to the cart detail URL, which will display all the contents
         of the cart.
     '''
-    cart = Cart(request)
+    cart = get_cart(request)
     product = get_object_or_404(Product, id=product_id)
-    cart.remove(product)
+    try:
+        cart.remove(product)
+    except CartUnavailable:
+        messages.error(request, 'Your cart is temporarily unavailable, please try again.')
     return redirect('cart:cart_detail')
 
 
 def cart_detail(request):
     '''View which renders the cart and its items.'''
-    cart = Cart(request)
-    for item in cart:
-        #create  an instance of the CartAddProductForm for each item to allow changing quantities
-        item['update_quantity_form'] = CartAddProductForm(initial={'quantity':item['quantity'], 'override':True})
+    cart = get_cart(request)
+    # each line item provides an update_quantity_form to allow changing quantities
     coupon_apply_form = CouponApplyForm()
+    # update the prices of the cart and remove the products no longer available
+    cart_changes = cart.reconcile()
 
     if not cart.is_empty:
         r = Recommender()
-        cart_products = [item['product'] for item in cart]
+        cart_products = [item.product for item in cart]
         recommended_products = r.suggest_products_for(cart_products, max_results=4)
     else:
         recommended_products = None
@@ -71,6 +79,7 @@ def cart_detail(request):
         'cart/detail.html',
         {'cart':cart,
         'coupon_apply_form':coupon_apply_form,
+        'cart_changes':cart_changes,
         'recommended_products':recommended_products}
         )
 
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.cache import cache
+from .models import Coupon
+
+
+def get_coupon_cache_key(id):
+    '''Function to build the cache key for a coupon.
+
+    Args:
+        id: ID property of the Coupon object.
+
+    Returns:
+        Cache key for the coupon.
+    '''
+    return f'coupons:coupon:{id}'
+
+
+def get_coupon(id):
+    '''Retrieve a coupon from the cache, or from the database if it is not cached yet.
+
+    Coupons are kept in the cache for COUPON_CACHE_TIMEOUT seconds, and removed from it
+    when they are saved or deleted, so the cart, checkout and order creation share a
+    single lookup.
+
+    Args:
+        id: ID property of the Coupon object.
+
+    Returns:
+        The Coupon object, or None if it does not exist.
+    '''
+    key = get_coupon_cache_key(id)
+    coupon = cache.get(key)
+    if coupon is None:
+        try:
+            coupon = Coupon.objects.get(id=id)
+        except Coupon.DoesNotExist:
+            return None
+        cache.set(key, coupon, getattr(settings, 'COUPON_CACHE_TIMEOUT', 5 * 60))
+    return coupon
+
+
+def invalidate_coupon(id):
+    '''Remove the coupon with the given ID from the cache.'''
+    cache.delete(get_coupon_cache_key(id))
@@ -0,0 +1,11 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Coupon
+from .cache import invalidate_coupon
+
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def coupon_changed(sender, instance, **kwargs):
+    '''Invalidate the cached copy of a coupon when it is saved or deleted.'''
+    invalidate_coupon(instance.id)
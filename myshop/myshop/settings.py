@@ -49,6 +49,7 @@ INSTALLED_APPS = [
     'orders.apps.OrdersConfig',
     'payment.apps.PaymentConfig',
     'coupons.apps.CouponsConfig',
+    'outbox.apps.OutboxConfig',
 ]
 
 MIDDLEWARE = [
@@ -145,6 +146,11 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
 # Shopping cart sessions
 CART_SESSION_ID = 'cart'
+# storage of the carts, cart.storage.RedisCartStore keeps each cart as a Redis hash
+# and only its key in the session
+CART_STORE = 'cart.storage.SessionCartStore'
+# seconds a cart stored in Redis is kept after its last change
+CART_REDIS_TIMEOUT = 60 * 60 * 24 * 14
 
 #SMTP Email settings
 EMAIL_HOST = os.getenv('EMAIL_HOST')
@@ -153,6 +159,16 @@ EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 EMAIL_PORT = os.getenv('EMAIL_PORT')
 EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS')
 
+# Outbox settings
+# number of emails sent over one connection to the mail server
+OUTBOX_BATCH_SIZE = 100
+# attempts to send an email before it is marked as failed, the delay between attempts
+# starts at OUTBOX_RETRY_DELAY seconds and doubles after every attempt
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 60
+# seconds after which an email claimed by a sender that died is sent again
+OUTBOX_LEASE_TIMEOUT = 5 * 60
+
 #Braintree (development) settings 
 BRAINTREE_MERCHANT_ID = os.getenv('BRAINTREE_MERCHANT_ID')
 BRAINTREE_PUBLIC_KEY = os.getenv('BRAINTREE_PUBLIC_KEY')
@@ -170,4 +186,68 @@ BRAINTREE_CONF = braintree.Configuration(
 # Redis settings
 REDIS_HOST = os.getenv('REDIS_HOST')
 REDIS_PORT = os.getenv('REDIS_PORT')
-REDIS_DB = os.getenv('REDIS_DB')
\ No newline at end of file
+REDIS_DB = os.getenv('REDIS_DB')
+# the connection pool of the recommender is created on first use
+REDIS_MAX_CONNECTIONS = 50
+# seconds to wait for Redis before the recommendations fall back to an empty result
+REDIS_SOCKET_TIMEOUT = 0.5
+REDIS_SOCKET_CONNECT_TIMEOUT = 0.5
+# seconds to wait for Redis in the batch and maintenance work, e.g. rebuilds and decays,
+# which uses a separate connection pool
+REDIS_BATCH_SOCKET_TIMEOUT = 30
+# seconds between health checks of idle connections
+REDIS_HEALTH_CHECK_INTERVAL = 30
+# seconds to skip Redis for recommendations after it failed
+REDIS_RETRY_INTERVAL = 5
+
+# Product cache settings
+# number of products kept in the process-local cache of each worker
+PRODUCT_CACHE_SIZE = 1000
+# seconds a product is kept in the process-local cache
+PRODUCT_CACHE_LOCAL_TIMEOUT = 30
+# seconds a product is kept in the Django cache; the default Django cache is local to
+# each process, so the products changed by another process are served for up to
+# PRODUCT_CACHE_TIMEOUT seconds, configure a shared cache in CACHES, e.g. memcached,
+# to have the changes reach every process at once
+PRODUCT_CACHE_TIMEOUT = 60
+
+# seconds a coupon is kept in the cache
+COUPON_CACHE_TIMEOUT = 5 * 60
+
+# number of orders read per query by the CSV exports of the orders
+ORDER_EXPORT_CHUNK_SIZE = 2000
+
+# number of processes rendering the PDF invoices, 0 renders them in the process of the
+# request
+INVOICE_RENDER_WORKERS = 2
+# seconds to wait for the rendering of an invoice
+INVOICE_RENDER_TIMEOUT = 60
+
+# Recommender settings
+# storage backend of the recommender, shop.backends.InMemoryBackend needs no Redis server
+RECOMMENDER_BACKEND = 'shop.backends.RedisBackend'
+# maximum number of commands sent to Redis in a single pipeline round trip
+RECOMMENDER_PIPELINE_SIZE = 1000
+# materialize a small top-N list per product, refreshed by the refresh_recommendations
+# Celery task (or management command) for the products touched by new purchases
+RECOMMENDER_MATERIALIZE = False
+RECOMMENDER_TOP_N = 10
+# maximum number of co-purchased products kept per product, the lowest scores are trimmed
+# by the decay_recommendations task (purchases may grow a set to twice the width between decays)
+RECOMMENDER_MAX_WIDTH = 100
+# the decay_recommendations task multiplies all scores by the decay factor and
+# removes the co-purchased products whose score drops below the minimum score
+RECOMMENDER_DECAY_FACTOR = 0.95
+RECOMMENDER_DECAY_MIN_SCORE = 0.1
+
+# Celery beat schedule
+CELERY_BEAT_SCHEDULE = {
+    'decay-recommendations': {
+        'task': 'shop.tasks.decay_recommendations',
+        'schedule': 60 * 60 * 24,
+    },
+    'send-outbox': {
+        'task': 'outbox.tasks.send_outbox',
+        'schedule': 10,
+    },
+}
\ No newline at end of file
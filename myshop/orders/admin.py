@@ -1,8 +1,14 @@
-import csv
-import datetime
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.contrib import admin
-from .models import Order, OrderItem
+from django.contrib.admin import helpers
+from django.contrib.admin.utils import prepare_lookup_value
+from django.contrib.admin.views.main import IGNORED_PARAMS
+from django.db import transaction
+from django.db.models import Count, Max
+from .models import Order, OrderItem, ExportJob
+from .exports import iter_order_rows, iter_csv
+from .tasks import export_orders
+from .invoices import iter_invoices_zip
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 
@@ -13,54 +19,96 @@ class OrderItemInline(admin.TabularInline):
     raw_id_fields = ['product']
 
 
-def export_to_csv(modeladmin, request, queryset):
+def export_to_csv(modeladmin, request, queryset, include_items=False):
     '''Custom admin action to download a list of orders as a CSV file.
 
     The function performs the following:
-    1. Creates an instance of HttpResponse, specifying the text/csv content type,
+    1. Creates an instance of StreamingHttpResponse, specifying the text/csv content type,
         to tell the browser the reponse has to be treated as a CSV file. Also adds
         a Content-Disposition header to indicate that the HTTP response contains
         an attached file.
-    2. Creates a CSV writer object that will write to the response object.
-    3. Get the model fields dynamically using the get_fields() method of the model
-        _meta options. Excludes many-to-many and one-to-many relationships.
-    4. Writes a header row including the field names.
-    5. Iterate over the given QuerySet and write a row for each object returned by
-        the QuerySet.
-    6. Cutomize the display name for the action in the actions dropdown element of
+    2. The content of the response is generated while it is sent: the orders of the
+        QuerySet are read in chunks and formatted by a CSV writer one row at a time (see
+        orders.exports.iter_order_rows), so the memory used does not depend on the
+        number of orders.
+    3. The first row includes the field names of the model, excluding many-to-many and
+        one-to-many relationships.
+    4. Cutomize the display name for the action in the actions dropdown element of
         the admin site by setting a short_description attribute on the function.
 
     Args:
         modelAdmin: the current ModelAdmin being displayed. 
         request: The current request object as an HTTPRequest instance.
         queryset: A queryset for the objects selected by the user.
+        include_items (bool): Optional, whether to write a row per item of the orders.
 
     Returns:
-        A generic administration action that can be added to any ModelAdmin class.
+        A StreamingHttpResponse with the CSV file.
     '''
     opts = modeladmin.model._meta
-    content_disposition = f'attachment; filename={opts.verbose_name}.csv'
-    response = HttpResponse(content_type='text/csv')
+    suffix = '_items' if include_items else ''
+    content_disposition = f'attachment; filename={opts.verbose_name}{suffix}.csv'
+    rows = iter_order_rows(queryset, include_items=include_items)
+    response = StreamingHttpResponse(iter_csv(rows), content_type='text/csv')
     response['Content-Disposition'] = content_disposition
-    writer = csv.writer(response)
-
-    fields = [field for field in opts.get_fields() if not field.many_to_many and not field.one_to_many]
-    # Write a first row with header information
-    writer.writerow([field.verbose_name for field in fields])
-    # Write data rows
-    for obj in queryset:
-        data_row = []
-        for field in fields:
-            value = getattr(obj, field.name)
-            if isinstance(value, datetime.datetime):
-                value = value.strftime('%d/%m/%Y')
-            data_row.append(value)
-        writer.writerow(data_row)
     return response
 #Specifying the name of the dropdown function as 'Export to CSV'
 export_to_csv.short_description = 'Export to CSV'
 
 
+def export_items_to_csv(modeladmin, request, queryset):
+    '''Custom admin action to download a list of orders as a CSV file with a row per
+    item, see export_to_csv.'''
+    return export_to_csv(modeladmin, request, queryset, include_items=True)
+export_items_to_csv.short_description = 'Export to CSV with items'
+
+
+def export_in_background(modeladmin, request, queryset, include_items=False):
+    '''Custom admin action to export a list of orders as a compressed CSV file with the
+    export_orders Celery task, instead of in the request. The file can be downloaded
+    from the export jobs page of the admin site once it has been written.
+
+    The job stores the lookups selecting the orders rather than their ID's: the lookups
+    of the changelist filters, the ID's of the orders checked on the page unless all
+    the orders are selected, and the last ID selected, so that the orders placed later
+    are not exported.'''
+    # the changelist filters were validated when the queryset of the action was built
+    filters = {
+        key: prepare_lookup_value(key, value)
+        for key, value in request.GET.items() if key not in IGNORED_PARAMS
+    }
+    if request.POST.get('select_across') != '1':
+        filters['id__in'] = [int(id) for id in request.POST.getlist(helpers.ACTION_CHECKBOX_NAME)]
+    selection = queryset.aggregate(total=Count('id'), last_id=Max('id'))
+    filters['id__lte'] = selection['last_id'] or 0
+    job = ExportJob.objects.create(
+        include_items=include_items,
+        filters=filters,
+        total=selection['total']
+    )
+    # launch asynchronous task once the job is committed
+    transaction.on_commit(lambda: export_orders.delay(job.id))
+    modeladmin.message_user(request, f'{job} of {job.total} orders has been queued.')
+export_in_background.short_description = 'Export to CSV in the background'
+
+
+def export_items_in_background(modeladmin, request, queryset):
+    '''Custom admin action to export a list of orders with a row per item in the
+    background, see export_in_background.'''
+    export_in_background(modeladmin, request, queryset, include_items=True)
+export_items_in_background.short_description = 'Export to CSV with items in the background'
+
+
+def download_invoices(modeladmin, request, queryset):
+    '''Custom admin action to download the PDF invoices of the selected orders as a ZIP
+    file. The invoices are rendered in parallel and the ZIP file is streamed as they
+    are rendered, see orders.invoices.iter_invoices_zip.'''
+    response = StreamingHttpResponse(iter_invoices_zip(queryset), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=invoices.zip'
+    return response
+download_invoices.short_description = 'Download invoices'
+
+
 def order_detail(obj):
     '''Function that takes an Order object as an argument and returns an HTML link for the admin_order_detail URL.'''
     url = reverse('orders:admin_order_detail', args=[obj.id])
@@ -77,7 +125,36 @@ order_pdf.short_description = 'Invoice'
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ['id', 'first_name', 'last_name', 'email', 'address', 'postal_code', 'city', 'paid', 'created', 'updated', order_detail, order_pdf]
+    list_display = ['id', 'first_name', 'last_name', 'email', 'address', 'postal_code', 'city', 'total_cost', 'paid', 'created', 'updated', order_detail, order_pdf]
     list_filter = ['paid', 'created', 'updated']
+    # the totals are computed from the items and the discount when the order is saved
+    readonly_fields = ['subtotal', 'discount_amount', 'total_cost']
     inlines = [OrderItemInline]
-    actions = [export_to_csv]
\ No newline at end of file
+    actions = [export_to_csv, export_items_to_csv, export_in_background, export_items_in_background, download_invoices]
+
+
+def export_download(obj):
+    '''Function that takes an ExportJob object as an argument and returns a link to download its file.'''
+    if obj.status != ExportJob.DONE:
+        return ''
+    url = reverse('orders:admin_export_download', args=[obj.id])
+    return mark_safe(f'<a href="{url}">Download</a>')
+export_download.short_description = 'File'
+
+
+def export_progress(obj):
+    '''Function that takes an ExportJob object as an argument and returns its progress.'''
+    return f'{obj.get_progress()}%'
+export_progress.short_description = 'Progress'
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'created', 'status', export_progress, 'total', 'include_items', 'finished', export_download]
+    list_filter = ['status', 'created']
+    exclude = ['filters']
+    readonly_fields = ['created', 'finished', 'status', 'include_items', 'compress', 'total', 'exported', 'file', 'error']
+
+    def has_add_permission(self, request):
+        # export jobs are created by the export actions of the orders
+        return False
@@ -0,0 +1,107 @@
+import csv
+import datetime
+from itertools import groupby, islice
+from django.conf import settings
+from .models import OrderItem
+
+# columns of the item lines, added to the order columns when the items are exported
+ITEM_HEADERS = ['product', 'item price', 'item quantity', 'item cost']
+
+
+class Echo(object):
+    '''File-like object whose write method returns the written value instead of storing
+    it, so that a csv.writer can format the rows one at a time for a streaming response.'''
+
+    def write(self, value):
+        return value
+
+
+def get_export_fields(opts):
+    '''Return the fields of a model that are exported, excluding the many-to-many and
+    one-to-many relationships.'''
+    return [field for field in opts.get_fields() if not field.many_to_many and not field.one_to_many]
+
+
+def format_value(value):
+    '''Format a value for the CSV file, dates are written as dd/mm/yyyy.'''
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%d/%m/%Y')
+    return value
+
+
+def iter_chunks(queryset, chunk_size):
+    '''Iterate over a queryset with a server-side cursor where the database supports it,
+    yielding lists of at most chunk_size objects.'''
+    objects = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(objects, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_order_rows(queryset, include_items=False, select_related=True, chunk_size=None, progress=None):
+    '''Generate the rows of a CSV export of orders, starting with the header row.
+
+    The orders are read in chunks, so the memory used does not depend on the number of
+    orders exported. With include_items=True an order is exported as one row per item,
+    with the product, price, quantity and cost of the item added to the order columns,
+    and the items of each chunk of orders are read with a single query.
+
+    Args:
+        queryset: A queryset of Order objects.
+        include_items (bool): Optional, whether to export the items of the orders.
+            Defaults to False.
+        select_related (bool): Optional, whether to read the related objects of the
+            foreign keys, e.g. the coupon, in the same query as the orders. Defaults to True.
+        chunk_size (int): Optional, the number of orders read per query. Defaults to the
+            ORDER_EXPORT_CHUNK_SIZE setting.
+        progress: Optional, function called with the number of orders exported so far
+            after each chunk of orders.
+
+    Returns:
+        Generator of rows, lists of values.
+    '''
+    chunk_size = chunk_size or getattr(settings, 'ORDER_EXPORT_CHUNK_SIZE', 2000)
+    fields = get_export_fields(queryset.model._meta)
+    header = [field.verbose_name for field in fields]
+    yield header + ITEM_HEADERS if include_items else header
+
+    if select_related:
+        related = [field.name for field in fields if field.many_to_one]
+        if related:
+            queryset = queryset.select_related(*related)
+    # the prefetched items would be ignored by iterator(), they are read per chunk instead
+    queryset = queryset.prefetch_related(None)
+
+    exported = 0
+    for orders in iter_chunks(queryset, chunk_size):
+        items = {}
+        if include_items:
+            lines = OrderItem.objects.filter(
+                order_id__in=[order.id for order in orders]
+            ).select_related('product').order_by('order_id', 'id')
+            items = {
+                order_id: list(order_items)
+                for order_id, order_items in groupby(lines, key=lambda item: item.order_id)
+            }
+        for order in orders:
+            row = [format_value(getattr(order, field.name)) for field in fields]
+            if not include_items:
+                yield row
+                continue
+            order_items = items.get(order.id)
+            if not order_items:
+                yield row + [''] * len(ITEM_HEADERS)
+            for item in order_items or ():
+                yield row + [item.product.name, item.price, item.quantity, item.get_cost()]
+        exported += len(orders)
+        if progress is not None:
+            progress(exported)
+
+
+def iter_csv(rows):
+    '''Format the given rows as CSV lines, one string per row.'''
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
@@ -0,0 +1,244 @@
+import posixpath
+import zipfile
+from collections import deque
+from concurrent.futures import Future
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.template.loader import render_to_string
+from django.db.models import Prefetch, prefetch_related_objects
+from django.utils.crypto import salted_hmac
+from .models import Order, OrderItem
+from .exports import iter_chunks
+from .rendering import get_render_pool, submit_pdf, render_html_to_pdf
+
+# directory of the stored invoices, relative to MEDIA_ROOT
+INVOICE_DIR = 'invoices'
+# part of the version of every invoice, increase it when orders/order/pdf.html or
+# css/pdf.css change so that the stored invoices are rendered again
+INVOICE_TEMPLATE_VERSION = 1
+
+
+def get_invoice_queryset():
+    '''Function returning the queryset of the orders to build invoices for, reading the
+    coupon in the same query as the orders.'''
+    return Order.objects.select_related('coupon')
+
+
+def prefetch_invoice_items(orders):
+    '''Function reading the items of the given orders and their products with a single
+    query, unless they have been read already.
+
+    Args:
+        orders (list): List of Order objects.
+
+    Returns:
+        None
+    '''
+    prefetch_related_objects(
+        orders,
+        Prefetch('items', queryset=OrderItem.objects.select_related('product').order_by('id'))
+    )
+
+
+def get_invoice_context(order):
+    '''Function building the context of the invoice templates of an order, with the items
+    and their products read in a single query and the totals computed once, so that
+    rendering the invoice makes no further queries.
+
+    Args:
+        order: The Order object, preferably from get_invoice_queryset.
+
+    Returns:
+        Dictionary with the order, its items, the discount and the total cost.
+    '''
+    prefetch_invoice_items([order])
+    return {
+        'order': order,
+        'items': list(order.items.all()),
+        'discount': order.get_discount(),
+        'total': order.get_total_cost(),
+    }
+
+
+def render_invoice_html(order):
+    '''Function rendering the HTML of the invoice of an order.'''
+    return render_to_string('orders/order/pdf.html', get_invoice_context(order))
+
+
+def render_invoice_pdf(order):
+    '''Function to render the PDF invoice of an order with WeasyPrint.
+
+    Args:
+        order: The Order object.
+
+    Returns:
+        The PDF file, as bytes.
+    '''
+    return render_html_to_pdf(render_invoice_html(order))
+
+
+def get_invoice_version(order):
+    '''Function returning the version of the invoice of an order, which changes when the
+    order is updated, paid, or its totals change.
+
+    The version is signed with the SECRET_KEY, so the names of the stored invoices
+    cannot be guessed.
+
+    Args:
+        order: The Order object.
+
+    Returns:
+        String version of the invoice.
+    '''
+    state = ':'.join(str(value) for value in [
+        INVOICE_TEMPLATE_VERSION,
+        order.id,
+        order.updated.isoformat(),
+        order.paid,
+        order.subtotal,
+        order.discount_amount,
+        order.total_cost,
+    ])
+    return salted_hmac('orders.invoices', state).hexdigest()
+
+
+def get_invoice_name(order):
+    '''Function returning the name of the stored invoice of an order, in the storage of
+    the media files.'''
+    return posixpath.join(INVOICE_DIR, str(order.id), f'{get_invoice_version(order)}.pdf')
+
+
+def read_invoice_pdf(name):
+    '''Function returning the stored invoice with the given name, or None if it has not
+    been stored.'''
+    if not default_storage.exists(name):
+        return None
+    with default_storage.open(name, 'rb') as f:
+        return f.read()
+
+
+def store_invoice_pdf(name, pdf):
+    '''Function storing an invoice under the given name, replacing the previous versions
+    of the invoice of the order.'''
+    directory = posixpath.dirname(name)
+    if default_storage.exists(directory):
+        for previous in default_storage.listdir(directory)[1]:
+            default_storage.delete(posixpath.join(directory, previous))
+    default_storage.save(name, ContentFile(pdf))
+
+
+def get_invoice_pdf(order):
+    '''Function returning the PDF invoice of an order, read from the storage of the media
+    files if the current version of the invoice has been rendered before. Otherwise the
+    invoice is rendered and stored, replacing the previous versions.
+
+    Args:
+        order: The Order object.
+
+    Returns:
+        The PDF file, as bytes.
+    '''
+    name = get_invoice_name(order)
+    pdf = read_invoice_pdf(name)
+    if pdf is None:
+        pdf = render_invoice_pdf(order)
+        store_invoice_pdf(name, pdf)
+    return pdf
+
+
+def iter_invoice_pdfs(queryset, chunk_size=100, progress=None):
+    '''Function generating the PDF invoices of many orders, rendered in parallel by the
+    pool of rendering processes.
+
+    The orders are read in chunks, with the items and products of each chunk read by a
+    single query, and at most two invoices per rendering process are queued at a time,
+    so the memory used does not depend on the number of orders. The invoices that have
+    been stored before are read from the storage, the others are rendered and stored.
+
+    Args:
+        queryset: A queryset of Order objects.
+        chunk_size (int): Optional, the number of orders read per query. Defaults to 100.
+        progress: Optional, function called with the number of invoices generated so far
+            once each invoice has been consumed.
+
+    Returns:
+        Generator of (order, pdf) tuples, in the order of the queryset.
+    '''
+    timeout = getattr(settings, 'INVOICE_RENDER_TIMEOUT', 60)
+    if get_render_pool() is not None:
+        max_pending = 2 * getattr(settings, 'INVOICE_RENDER_WORKERS', 2)
+    else:
+        max_pending = 1
+    pending = deque()
+
+    def finish():
+        order, name, future, stored = pending.popleft()
+        pdf = future.result(timeout=timeout)
+        if not stored:
+            store_invoice_pdf(name, pdf)
+        return order, pdf
+
+    def results():
+        for orders in iter_chunks(queryset.select_related('coupon'), chunk_size):
+            prefetch_invoice_items(orders)
+            for order in orders:
+                name = get_invoice_name(order)
+                pdf = read_invoice_pdf(name)
+                if pdf is not None:
+                    future = Future()
+                    future.set_result(pdf)
+                else:
+                    future = submit_pdf(render_invoice_html(order))
+                pending.append((order, name, future, pdf is not None))
+                if len(pending) >= max_pending:
+                    yield finish()
+        while pending:
+            yield finish()
+
+    for count, result in enumerate(results(), 1):
+        yield result
+        if progress is not None:
+            progress(count)
+
+
+class ZipBuffer(object):
+    '''Write-only file-like object collecting the output of a ZipFile, which is taken out
+    with pop() after each file written, so that a ZIP file can be streamed.'''
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        '''Return and remove the data written since the last call.'''
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_invoices_zip(queryset, progress=None):
+    '''Function generating a ZIP file with the PDF invoices of many orders, see
+    iter_invoice_pdfs.
+
+    Args:
+        queryset: A queryset of Order objects.
+        progress: Optional, function called with the number of invoices written to the
+            ZIP file so far.
+
+    Returns:
+        Generator of the parts of the ZIP file, as bytes.
+    '''
+    buffer = ZipBuffer()
+    # the PDF files are already compressed
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for order, pdf in iter_invoice_pdfs(queryset, progress=progress):
+            archive.writestr(f'invoice_{order.id}.pdf', pdf)
+            yield buffer.pop()
+    yield buffer.pop()
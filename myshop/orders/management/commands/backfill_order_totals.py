@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from orders.models import Order
+
+
+class Command(BaseCommand):
+    '''Management command to compute the stored totals of the existing orders again, e.g.
+    after the items were changed without sending signals. The totals of the orders created
+    before the totals were stored on Order are computed by the migration 0004_order_totals.
+
+    The subtotals are computed by the database, a chunk of orders at a time, and the
+    totals of each chunk are written with a single bulk update.
+    '''
+    help = 'Compute the subtotal, discount amount and total cost of the existing orders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of orders updated per query.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        orders = Order.objects.order_by('id').with_totals().only('id', 'discount')
+        batch = []
+        updated = 0
+        for order in orders.iterator(chunk_size=batch_size):
+            order.compute_totals(order.items_subtotal)
+            batch.append(order)
+            if len(batch) == batch_size:
+                updated += self.update(batch)
+        updated += self.update(batch)
+        self.stdout.write(self.style.SUCCESS(f'Updated the totals of {updated} orders.'))
+
+    def update(self, batch):
+        '''Write the totals of a batch of orders and empty the batch.'''
+        Order.objects.bulk_update(batch, ['subtotal', 'discount_amount', 'total_cost'])
+        count = len(batch)
+        batch.clear()
+        if count:
+            self.stdout.write(f'Updated {count} orders...')
+        return count
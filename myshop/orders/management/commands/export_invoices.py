@@ -0,0 +1,46 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from orders.models import Order
+from orders.invoices import iter_invoices_zip
+
+
+class Command(BaseCommand):
+    '''Management command to write the PDF invoices of the orders created in a period to a
+    ZIP file, e.g. for the month-end invoice run.
+
+    The invoices are rendered in parallel by the pool of rendering processes, and the
+    ZIP file is written as they are rendered, see orders.invoices.iter_invoices_zip.
+    '''
+    help = 'Write the PDF invoices of the orders to a ZIP file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Path of the ZIP file.')
+        parser.add_argument('--since', help='First day of the period, as YYYY-MM-DD.')
+        parser.add_argument('--until', help='Last day of the period, as YYYY-MM-DD.')
+        parser.add_argument('--paid', action='store_true', help='Only the paid orders.')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.order_by('id')
+        try:
+            if options['since']:
+                orders = orders.filter(created__date__gte=datetime.date.fromisoformat(options['since']))
+            if options['until']:
+                orders = orders.filter(created__date__lte=datetime.date.fromisoformat(options['until']))
+        except ValueError as e:
+            raise CommandError(e)
+        if options['paid']:
+            orders = orders.filter(paid=True)
+
+        total = orders.count()
+        written = 0
+
+        def progress(count):
+            nonlocal written
+            written = count
+            if written % 100 == 0:
+                self.stdout.write(f'Written {written}/{total} invoices...')
+
+        with open(options['output'], 'wb') as f:
+            for part in iter_invoices_zip(orders, progress=progress):
+                f.write(part)
+        self.stdout.write(self.style.SUCCESS(f'Written {written} invoices to {options["output"]}.'))
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.7 on 2026-10-18 19:42
+
+import decimal
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def compute_order_totals(apps, schema_editor):
+    '''Compute the totals of the existing orders from their items, the same way as
+    Order.compute_totals, so that no order is left with a total cost of 0.'''
+    Order = apps.get_model('orders', 'Order')
+    cents = decimal.Decimal('0.01')
+    orders = Order.objects.order_by('id').annotate(
+        items_subtotal=Sum(F('items__price') * F('items__quantity'), output_field=models.DecimalField(max_digits=10, decimal_places=2))
+    ).only('id', 'discount')
+    batch = []
+    for order in orders.iterator(chunk_size=1000):
+        order.subtotal = decimal.Decimal(order.items_subtotal or 0).quantize(cents, decimal.ROUND_HALF_UP)
+        order.discount_amount = (order.subtotal * order.discount / decimal.Decimal(100)).quantize(cents, decimal.ROUND_HALF_UP)
+        order.total_cost = order.subtotal - order.discount_amount
+        batch.append(order)
+        if len(batch) == 1000:
+            Order.objects.bulk_update(batch, ['subtotal', 'discount_amount', 'total_cost'])
+            batch = []
+    if batch:
+        Order.objects.bulk_update(batch, ['subtotal', 'discount_amount', 'total_cost'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0003_auto_20210913_1354'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='discount_amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.RunPython(compute_order_totals, migrations.RunPython.noop),
+    ]
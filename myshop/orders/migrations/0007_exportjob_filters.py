@@ -0,0 +1,30 @@
+# Generated by Django 3.2.7 on 2026-10-18 20:11
+
+from django.db import migrations, models
+
+
+def convert_order_ids(apps, schema_editor):
+    '''Select the orders of the existing jobs by their stored ID's.'''
+    ExportJob = apps.get_model('orders', 'ExportJob')
+    for job in ExportJob.objects.only('id', 'order_ids'):
+        ExportJob.objects.filter(id=job.id).update(filters={'id__in': job.order_ids})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0006_exportjob_order_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='filters',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.RunPython(convert_order_ids, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='exportjob',
+            name='order_ids',
+        ),
+    ]
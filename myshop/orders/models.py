@@ -1,12 +1,63 @@
 import decimal
 from django.core import validators
 from django.db import models
+from django.db.models import DecimalField, F, Func, Prefetch, Sum, Value
+from django.db.models.functions import Coalesce
 from shop.models import Product
 from decimal import Decimal
 from django.core.validators import MinValueValidator, MaxValueValidator
 from coupons.models import Coupon
 
 
+class OrderQuerySet(models.QuerySet):
+    '''QuerySet of the Order Model.'''
+
+    def with_totals(self, prefetch_items=False):
+        '''Annotate the orders with totals computed by the database from their items, in
+        the same query as the orders, independently of the totals stored on the orders.
+
+        The annotations are items_subtotal (the total cost of the items), items_discount
+        (the amount deducted by the discount) and items_total (the total cost after the
+        discount).
+
+        Args:
+            prefetch_items (bool): Optional, whether to prefetch the items of the orders
+                and their products, with one query each. Defaults to False.
+
+        Returns:
+            The annotated QuerySet.
+        '''
+        amount = DecimalField(max_digits=10, decimal_places=2)
+        queryset = self.annotate(
+            items_subtotal=Coalesce(
+                Sum(F('items__price') * F('items__quantity'), output_field=amount),
+                Value(0),
+                output_field=amount
+            )
+        ).annotate(
+            # rounded to cents like Order.compute_totals, the subtotal is multiplied by a
+            # decimal rather than divided by 100, which would be an integer division on SQLite
+            items_discount=Func(
+                F('items_subtotal') * F('discount') * Value(Decimal('0.01'), output_field=amount),
+                Value(2),
+                function='ROUND',
+                output_field=amount
+            )
+        ).annotate(
+            items_total=Func(
+                F('items_subtotal') - F('items_discount'),
+                Value(2),
+                function='ROUND',
+                output_field=amount
+            )
+        )
+        if prefetch_items:
+            queryset = queryset.prefetch_related(
+                Prefetch('items', queryset=OrderItem.objects.select_related('product'))
+            )
+        return queryset
+
+
 class Order(models.Model):
     '''Order Model to store order detail.'''
     first_name = models.CharField(max_length=50)
@@ -21,6 +72,12 @@ class Order(models.Model):
     braintree_id = models.CharField(max_length=150, blank=True)
     coupon = models.ForeignKey(Coupon, related_name='orders', null=True, blank=True,on_delete=models.CASCADE)
     discount = models.IntegerField(default=0, validators=[MinValueValidator(0), MaxValueValidator(100)])
+    # totals of the order, kept up to date when the items or the discount change
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    discount_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    total_cost = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    objects = OrderQuerySet.as_manager()
 
 
     class Meta:
@@ -31,15 +88,51 @@ class Order(models.Model):
         return f'Order {self.id}'
 
 
+    def save(self, *args, **kwargs):
+        '''Save the order, computing the discount amount and total cost from the stored
+        subtotal, so that they follow changes of the discount.'''
+        self.compute_totals()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'discount_amount', 'total_cost'}
+        super().save(*args, **kwargs)
+
+
+    def compute_totals(self, subtotal=None):
+        '''Compute the discount amount and total cost of the order, without saving it.
+
+        Args:
+            subtotal (Decimal): Optional, the total cost of the items. Defaults to the
+                stored subtotal.
+
+        Returns:
+            None
+        '''
+        if subtotal is not None:
+            self.subtotal = subtotal
+        cents = Decimal('0.01')
+        self.subtotal = Decimal(self.subtotal).quantize(cents, decimal.ROUND_HALF_UP)
+        self.discount_amount = (self.subtotal * self.discount / Decimal(100)).quantize(cents, decimal.ROUND_HALF_UP)
+        self.total_cost = self.subtotal - self.discount_amount
+
+
+    def update_totals(self):
+        '''Recompute the totals of the order from its items with a single aggregate query,
+        and save them.'''
+        subtotal = self.items.aggregate(subtotal=Sum(F('price') * F('quantity')))['subtotal']
+        self.compute_totals(subtotal or Decimal(0))
+        self.save(update_fields=['subtotal'])
+
+
     def get_total_cost(self):
         'Returns the total cost of all items in the order, after subtracting discounts.'
-        total_cost = sum(item.get_cost() for item in self.items.all())
-        return total_cost - total_cost*(self.discount/Decimal(100))
+        return self.total_cost
 
 
     def get_discount(self):
-        if self.coupon:
-            return (self.discount / Decimal(100)) * self.get_total_cost()/((Decimal(100)-self.discount)/Decimal(100))
+        'Returns the amount deducted from the total cost of the items by the coupon.'
+        if self.coupon_id:
+            return self.discount_amount
         return Decimal(0)
 
 
@@ -62,4 +155,60 @@ class OrderItem(models.Model):
 
     def get_cost(self):
         'Returns the total cost of the order by mutliplying the unit price and quantity.'
-        return self.price *self.quantity
\ No newline at end of file
+        return self.price *self.quantity
+
+
+class ExportJob(models.Model):
+    '''ExportJob Model to store the background CSV exports of orders, written by the
+    export_orders Celery task.
+
+    Fields:
+        created: Date and time the export was requested.
+        finished: Date and time the export was written or failed.
+        status: Pending, running, done or failed.
+        include_items: Whether the export has a row per order item.
+        compress: Whether the CSV file is compressed with gzip.
+        filters: The field lookups selecting the exported orders, see
+            orders.admin.export_in_background.
+        total: Number of orders to export.
+        exported: Number of orders exported so far.
+        file: The exported file, stored under MEDIA_ROOT.
+        error: The error message of a failed export.
+    '''
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    include_items = models.BooleanField(default=False)
+    compress = models.BooleanField(default=True)
+    filters = models.JSONField(default=dict)
+    total = models.PositiveIntegerField(default=0)
+    exported = models.PositiveIntegerField(default=0)
+    file = models.FileField(upload_to='exports/', blank=True)
+    error = models.TextField(blank=True)
+
+
+    class Meta:
+        ordering = ('-created',)
+
+
+    def __str__(self):
+        return f'Export {self.id}'
+
+
+    def get_progress(self):
+        '''Returns the percentage of the orders exported.'''
+        if not self.total:
+            return 100 if self.status == self.DONE else 0
+        return int(self.exported * 100 / self.total)
+
@@ -0,0 +1,128 @@
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import weasyprint
+try:
+    from weasyprint.text.fonts import FontConfiguration
+except ImportError:
+    # WeasyPrint < 53
+    from weasyprint.fonts import FontConfiguration
+from django.conf import settings
+
+# This module is imported by the rendering processes, which do not set up Django, so
+# it must not import models.
+
+# The stylesheet of the invoices and the font configuration are loaded once per
+# process, see load_renderer.
+_stylesheets = None
+_font_config = None
+# The pool of rendering processes is created on first use, see get_render_pool.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_stylesheet_path():
+    '''Function returning the path of the stylesheet of the invoices.'''
+    return settings.STATIC_ROOT + 'css/pdf.css'
+
+
+def load_renderer(stylesheet_path):
+    '''Function loading the font configuration and parsing the stylesheet of the invoices
+    in the current process, once. It is the initializer of the rendering processes.
+
+    Args:
+        stylesheet_path (str): The path of the stylesheet of the invoices.
+
+    Returns:
+        None
+    '''
+    global _stylesheets, _font_config
+    if _stylesheets is None:
+        _font_config = FontConfiguration()
+        _stylesheets = [weasyprint.CSS(filename=stylesheet_path, font_config=_font_config)]
+
+
+def render_pdf(html, stylesheet_path=None):
+    '''Function rendering an HTML document to PDF with WeasyPrint, using the stylesheet
+    and font configuration loaded in the current process.
+
+    Args:
+        html (str): The HTML document.
+        stylesheet_path (str): Optional, the path of the stylesheet, loaded if the
+            process has not loaded it yet. Defaults to the stylesheet of the invoices.
+
+    Returns:
+        The PDF file, as bytes.
+    '''
+    load_renderer(stylesheet_path or get_stylesheet_path())
+    return weasyprint.HTML(string=html).write_pdf(stylesheets=_stylesheets, font_config=_font_config)
+
+
+def get_render_pool():
+    '''Function returning the pool of rendering processes, creating it on the first call,
+    or None if the INVOICE_RENDER_WORKERS setting is 0.
+
+    The processes are started with spawn rather than fork, so they do not inherit the
+    threads and connections of a web worker, and each loads the stylesheet and fonts
+    once when it starts. Daemonic processes, e.g. the Celery prefork workers, cannot
+    start processes and have no pool, they render in the worker process itself, which
+    is long-lived and also loads the stylesheet and fonts once.
+
+    Returns:
+        A ProcessPoolExecutor object, or None.
+    '''
+    global _pool
+    workers = getattr(settings, 'INVOICE_RENDER_WORKERS', 2)
+    if not workers or multiprocessing.current_process().daemon:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=load_renderer,
+                    initargs=(get_stylesheet_path(),)
+                )
+    return _pool
+
+
+def submit_pdf(html):
+    '''Function queueing an HTML document to be rendered to PDF by the pool of rendering
+    processes, without waiting for the result. Without a pool the document is rendered
+    in the current process.
+
+    Args:
+        html (str): The HTML document.
+
+    Returns:
+        A concurrent.futures.Future object, whose result is the PDF file as bytes.
+    '''
+    global _pool
+    pool = get_render_pool()
+    if pool is None:
+        future = Future()
+        future.set_result(render_pdf(html))
+        return future
+    try:
+        return pool.submit(render_pdf, html, get_stylesheet_path())
+    except BrokenProcessPool:
+        # a rendering process died, replace the pool
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        return get_render_pool().submit(render_pdf, html, get_stylesheet_path())
+
+
+def render_html_to_pdf(html):
+    '''Function rendering an HTML document to PDF with the pool of rendering processes,
+    waiting at most INVOICE_RENDER_TIMEOUT seconds for the result, see submit_pdf.
+
+    Args:
+        html (str): The HTML document.
+
+    Returns:
+        The PDF file, as bytes.
+    '''
+    return submit_pdf(html).result(timeout=getattr(settings, 'INVOICE_RENDER_TIMEOUT', 60))
@@ -0,0 +1,14 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Order, OrderItem
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def order_item_changed(sender, instance, **kwargs):
+    '''Recompute the totals of the order of an item when the item is saved or deleted.'''
+    # the order is read again, as the instance cached on the item may be outdated, and
+    # it no longer exists when the item is deleted together with the order
+    order = Order.objects.filter(id=instance.order_id).first()
+    if order is not None:
+        order.update_totals()
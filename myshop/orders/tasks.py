@@ -1,26 +1,106 @@
+import csv
+import gzip
+import io
+import logging
+import tempfile
+import uuid
 from celery import shared_task
-from django.core.mail import send_mail
-from .models import Order
 from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+from .models import Order, ExportJob
+from .exports import iter_order_rows
+from outbox.mail import enqueue_mail
+
+logger = logging.getLogger(__name__)
 
 @shared_task
 def order_created(order_id):
-    '''Task to build an email notification when an order is successfully created.
+    '''Task to enqueue an email notification when an order is successfully created. The
+    email is sent by the send_outbox task, and only enqueued once per order, so a retried
+    task does not send it twice.
     
     Args:
         order_id: id of the order object.
 
     Returns:
-        send_email() function provided by Django to send an email notification to the user who placed the order.
+        True if the email was enqueued, False if it had been enqueued before.
     '''
     # Query the Order Model for the to obtain the Order object.
-    order = Order.objects.get(id=order_id)
+    order = Order.objects.only('id', 'first_name', 'email').get(id=order_id)
     subject = f'Order nr. {order.id}'
     message = f'Dear {order.first_name},\n\nYou have successfully placed an order. Your order ID is {order.id}.'
-    mail_sent = send_mail(
+    _, enqueued = enqueue_mail(
+        dedupe_key=f'order_created:{order.id}',
         subject=subject,
-        message=message,
-        from_email=settings.EMAIL_HOST_USER,
-        recipient_list=[order.email]
+        body=message,
+        to=[order.email]
     )
-    return mail_sent
\ No newline at end of file
+    return enqueued
+
+
+def iter_job_rows(job, progress):
+    '''Generate the rows of the CSV file of an ExportJob, see iter_order_rows.
+
+    The orders are selected with the stored lookups of the job and streamed with a
+    server-side cursor where the database supports it, see iter_order_rows.
+
+    Args:
+        job: The ExportJob object.
+        progress: Function called with the number of orders exported so far.
+
+    Returns:
+        Generator of rows, lists of values.
+    '''
+    queryset = Order.objects.filter(**job.filters).order_by('id')
+    return iter_order_rows(queryset, include_items=job.include_items, progress=progress)
+
+
+@shared_task
+def export_orders(job_id):
+    '''Task to write the CSV file of an ExportJob, optionally compressed with gzip.
+
+    The orders are read in chunks and the rows written to a temporary file as they are
+    generated, so the memory used does not depend on the size of the export. The number
+    of orders exported is stored on the job after each chunk. Once complete, the file
+    is saved under MEDIA_ROOT/exports/ with the storage of the file field.
+
+    Args:
+        job_id: id of the ExportJob object.
+
+    Returns:
+        The status of the job.
+    '''
+    job = ExportJob.objects.get(id=job_id)
+    ExportJob.objects.filter(id=job.id).update(status=ExportJob.RUNNING)
+
+    def progress(exported):
+        job.exported = exported
+        ExportJob.objects.filter(id=job.id).update(exported=exported)
+
+    try:
+        with tempfile.TemporaryFile() as tmp:
+            raw = gzip.GzipFile(fileobj=tmp, mode='wb') if job.compress else tmp
+            text = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+            writer = csv.writer(text)
+            for row in iter_job_rows(job, progress):
+                writer.writerow(row)
+            text.flush()
+            # leave the temporary file open, closing the gzip file only writes its trailer
+            text.detach()
+            if job.compress:
+                raw.close()
+            tmp.seek(0)
+            # the random part of the name keeps the file from being guessed under MEDIA_URL
+            name = f'orders_{job.id}_{uuid.uuid4().hex}.csv'
+            if job.compress:
+                name += '.gz'
+            job.file.save(name, File(tmp), save=False)
+        job.status = ExportJob.DONE
+    except Exception as e:
+        logger.exception('Export %s failed.', job.id)
+        job.status = ExportJob.FAILED
+        job.error = str(e)
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'error', 'file', 'exported', 'finished'])
+    return job.status
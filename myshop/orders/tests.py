@@ -1,3 +1,148 @@
-from django.test import TestCase
+import gzip
+import os
+import tempfile
+import zipfile
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from django.contrib.admin import helpers
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from shop.models import Category, Product
+from .models import Order, OrderItem, ExportJob
+from .tasks import export_orders
 
-# Create your tests here.
+
+class OrderTotalsTests(TestCase):
+    '''Tests of the totals stored on the orders and of OrderQuerySet.with_totals.'''
+
+    def setUp(self):
+        category = Category.objects.create(name='Tea', slug='tea')
+        self.product = Product.objects.create(category=category, name='Green tea', slug='green-tea', price=Decimal('10.00'))
+
+    def create_order(self, discount, items):
+        order = Order.objects.create(
+            first_name='Ada',
+            last_name='Lovelace',
+            email='ada@example.com',
+            address='12 St James Square',
+            postal_code='SW1Y 4JH',
+            city='London',
+            discount=discount
+        )
+        for price, quantity in items:
+            OrderItem.objects.create(order=order, product=self.product, price=Decimal(price), quantity=quantity)
+        order.refresh_from_db()
+        return order
+
+    def test_stored_totals(self):
+        order = self.create_order(15, [('10.00', 3)])
+        self.assertEqual(order.subtotal, Decimal('30.00'))
+        self.assertEqual(order.discount_amount, Decimal('4.50'))
+        self.assertEqual(order.total_cost, Decimal('25.50'))
+
+    def test_with_totals_fractional_discount(self):
+        order = self.create_order(15, [('10.00', 3)])
+        annotated = Order.objects.with_totals().get(id=order.id)
+        self.assertEqual(annotated.items_subtotal, Decimal('30.00'))
+        self.assertEqual(annotated.items_discount, Decimal('4.50'))
+        self.assertEqual(annotated.items_total, Decimal('25.50'))
+
+    def test_with_totals_matches_stored_totals(self):
+        cases = [
+            (15, [('33.33', 1)]),
+            (50, [('10.01', 1)]),
+            (33, [('19.99', 1), ('0.05', 3)]),
+            (0, [('12.34', 2)]),
+        ]
+        for discount, items in cases:
+            order = self.create_order(discount, items)
+            annotated = Order.objects.with_totals().get(id=order.id)
+            self.assertEqual(annotated.items_subtotal, order.subtotal)
+            self.assertEqual(annotated.items_discount, order.discount_amount)
+            self.assertEqual(annotated.items_total, order.total_cost)
+
+    def test_with_totals_without_items(self):
+        order = self.create_order(10, [])
+        annotated = Order.objects.with_totals().get(id=order.id)
+        self.assertEqual(annotated.items_subtotal, Decimal('0'))
+        self.assertEqual(annotated.items_total, Decimal('0'))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ExportJobTests(TestCase):
+    '''Tests of the background CSV exports of the orders.'''
+
+    def setUp(self):
+        self.orders = [
+            Order.objects.create(
+                first_name='Ada',
+                last_name='Lovelace',
+                email='ada@example.com',
+                address='12 St James Square',
+                postal_code='SW1Y 4JH',
+                city='London',
+                paid=paid
+            )
+            for paid in [True, False, True]
+        ]
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def export(self, query, data):
+        '''Run the export_in_background action of the changelist, then the task.'''
+        url = reverse('admin:orders_order_changelist') + query
+        with mock.patch('orders.admin.export_orders.delay'), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {'action': 'export_in_background', **data})
+        job = ExportJob.objects.get()
+        self.assertEqual(export_orders(job.id), ExportJob.DONE)
+        job.refresh_from_db()
+        with job.file.open('rb') as f:
+            lines = gzip.decompress(f.read()).decode().splitlines()
+        return job, [int(line.split(',')[0]) for line in lines[1:]]
+
+    def test_export_all_filtered_orders(self):
+        job, ids = self.export('?paid__exact=1', {
+            'select_across': '1',
+            helpers.ACTION_CHECKBOX_NAME: [self.orders[0].id]
+        })
+        self.assertEqual(ids, [self.orders[0].id, self.orders[2].id])
+        self.assertEqual((job.total, job.exported), (2, 2))
+
+    def test_export_selected_orders(self):
+        selected = [self.orders[1].id, self.orders[2].id]
+        job, ids = self.export('', {'select_across': '0', helpers.ACTION_CHECKBOX_NAME: selected})
+        self.assertEqual(ids, selected)
+        self.assertEqual((job.total, job.exported), (2, 2))
+
+    def test_orders_placed_later_are_not_exported(self):
+        url = reverse('admin:orders_order_changelist')
+        with mock.patch('orders.admin.export_orders.delay'), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {
+                'action': 'export_in_background',
+                'select_across': '1',
+                helpers.ACTION_CHECKBOX_NAME: [self.orders[0].id]
+            })
+        Order.objects.create(first_name='Charles', last_name='Babbage', email='charles@example.com')
+        job = ExportJob.objects.get()
+        export_orders(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.total, job.exported), (3, 3))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), INVOICE_RENDER_WORKERS=0)
+class ExportInvoicesTests(TestCase):
+    '''Tests of the export_invoices management command, with the rendering of the PDF
+    files replaced.'''
+
+    def test_export_invoices(self):
+        for _ in range(3):
+            Order.objects.create(first_name='Ada', last_name='Lovelace', email='ada@example.com')
+        output = os.path.join(tempfile.mkdtemp(), 'invoices.zip')
+        stdout = StringIO()
+        with mock.patch('orders.rendering.render_pdf', return_value=b'%PDF-1.7'):
+            call_command('export_invoices', output, stdout=stdout)
+        with zipfile.ZipFile(output) as archive:
+            self.assertEqual(len(archive.namelist()), 3)
+        self.assertIn('Written 3 invoices', stdout.getvalue())
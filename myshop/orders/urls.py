@@ -7,4 +7,5 @@ urlpatterns = [
     path('create/', views.order_create, name='order_create'),
     path('admin/order/<int:order_id>/', views.admin_order_detail, name="admin_order_detail"),
     path('admin/order/<int:order_id>/pdf/', views.admin_order_pdf, name='admin_order_pdf'),
+    path('admin/export/<int:job_id>/', views.admin_export_download, name='admin_export_download'),
 ]
@@ -1,14 +1,13 @@
 from django.shortcuts import redirect, render, get_object_or_404
-from .models import OrderItem, Order
+from .models import OrderItem, Order, ExportJob
 from .forms import OrderCreateForm
-from cart.cart import Cart
+from cart.cart import get_cart
 from .tasks import order_created
 from django.urls import reverse
+from django.db import transaction
 from django.contrib.admin.views.decorators import staff_member_required
-from django.conf import settings
-from django.http import HttpResponse
-from django.template.loader import render_to_string
-import weasyprint
+from django.http import HttpResponse, FileResponse, Http404
+from .invoices import get_invoice_pdf, get_invoice_queryset, get_invoice_context
 
 
 def order_create(request):
@@ -23,31 +22,51 @@ def order_create(request):
             the form (i.e. POST request), otherwise (i.e. GET request) renders 
                 the create.html template with an empty form.
     '''
-    cart = Cart(request)
+    cart = get_cart(request)
+    # update the prices of the cart and remove the products no longer available, an
+    # order is only placed for a cart that matches the catalog, which is always checked
+    # when the order is placed
+    cart_changes = cart.reconcile(force=request.method=='POST')
     if request.method=='POST':
         form = OrderCreateForm(request.POST)
-        if form.is_valid():
+        if form.is_valid() and not cart_changes and not cart.is_empty:
             order = form.save(commit=False)
             if cart.coupon:
                 order.coupon = cart.coupon
                 order.discount = cart.coupon.discount
-            order.save()
-            for item in cart:
-                OrderItem.objects.create(
+            # the products of the cart are loaded with a single query, and their current
+            # prices are stored with the items
+            items = [
+                OrderItem(
                     order=order,
-                    product=item['product'],
-                    price=item['price'])
+                    product=item.product,
+                    price=item.product.price,
+                    quantity=item.quantity)
+                for item in cart
+            ]
+            # the totals are stored with the order, bulk_create does not send the
+            # signals that update them
+            order.compute_totals(sum(item.get_cost() for item in items))
+            # the order and its items are saved together or not at all
+            with transaction.atomic():
+                order.save()
+                OrderItem.objects.bulk_create(items)
+                # launch asynchronous task (using celery and RabbitMQ) once the order
+                # is committed
+                transaction.on_commit(lambda: order_created.delay(order.id))
             # clear the cart
             cart.clear()
-            # launch asynchronous task (using celery and RabbitMQ)
-            order_created.delay(order.id)
             # set the order in the session
             request.session['order_id'] = order.id
             # redirect for payment
             return redirect(reverse('payment:process'))
     else:
         form = OrderCreateForm()
-    return render(request, 'orders/order/create.html', {'cart':cart,'form':form})
+    return render(
+        request,
+        'orders/order/create.html',
+        {'cart':cart,'form':form,'cart_changes':cart_changes}
+        )
 
 
 @staff_member_required
@@ -57,8 +76,8 @@ def admin_order_detail(request, order_id):
     
     Staff_member_required decorator is applied which checks that both the is_active and
     is_staff field of the user requesting the page is True. '''
-    order = get_object_or_404(Order, id=order_id)
-    return render(request, 'admin/orders/order/detail.html', {'order':order})
+    order = get_object_or_404(get_invoice_queryset(), id=order_id)
+    return render(request, 'admin/orders/order/detail.html', get_invoice_context(order))
 
 
 @staff_member_required
@@ -73,14 +92,27 @@ def admin_order_pdf(request, order_id):
     Returns:
         A PDF response object.
     '''
-    order = get_object_or_404(Order, id=order_id)
-    html = render_to_string('orders/order/pdf.html',
-                            {'order': order})
-    response = HttpResponse(content_type='application/pdf')
+    order = get_object_or_404(get_invoice_queryset(), id=order_id)
+    # the invoice is only rendered again when the order changed
+    response = HttpResponse(get_invoice_pdf(order), content_type='application/pdf')
     response['Content-Disposition'] = f'filename=order_{order.id}.pdf'
-    weasyprint.HTML(string=html).write_pdf(response,
-        stylesheets=[weasyprint.CSS(
-            settings.STATIC_ROOT + 'css/pdf.css')])
     return response
 
 
+@staff_member_required
+def admin_export_download(request, job_id):
+    '''View to download the file written by an ExportJob. The staff_member_required
+    decorator is used to check that only staff users can access the view.
+
+    Args:
+        request: The HTTP request object.
+        job_id: The given export job id, which is then used to retrieve the ExportJob Object.
+
+    Returns:
+        A streaming file response object.
+    '''
+    job = get_object_or_404(ExportJob, id=job_id)
+    if job.status != ExportJob.DONE or not job.file:
+        raise Http404('The export is not ready.')
+    extension = '.csv.gz' if job.compress else '.csv'
+    return FileResponse(job.file.open('rb'), as_attachment=True, filename=f'orders_{job.id}{extension}')
@@ -0,0 +1,11 @@
+from django.contrib import admin
+from .models import OutboxMessage
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    '''Register the OutboxMessage Model on the Admin Site.'''
+    list_display = ['dedupe_key', 'subject', 'status', 'attempts', 'next_attempt', 'created', 'sent']
+    list_filter = ['status', 'created']
+    search_fields = ['dedupe_key', 'subject']
+    readonly_fields = ['created', 'sent', 'attempts', 'last_error']
@@ -0,0 +1,179 @@
+import datetime
+import logging
+import posixpath
+import uuid
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+# directory of the attachments of the outbox messages, relative to MEDIA_ROOT
+OUTBOX_DIR = 'outbox'
+
+
+def enqueue_mail(dedupe_key, subject, body, to, from_email=None, attachments=()):
+    '''Function adding an email to the outbox, unless a message with the same dedupe key
+    has been enqueued before.
+
+    The attachments are copied to the storage of the media files, under OUTBOX_DIR, so
+    the message keeps them until it is sent even if the original files are replaced.
+
+    Args:
+        dedupe_key (str): Unique key of the message, e.g. 'order_created:42'.
+        subject (str): Subject of the email.
+        body (str): Plain text body of the email.
+        to (list): List of recipients.
+        from_email (str): Optional, the sender. Defaults to the EMAIL_HOST_USER setting.
+        attachments (list): Optional, list of (filename, content, mimetype) tuples, the
+            content being bytes.
+
+    Returns:
+        Tuple of the OutboxMessage object and a boolean, True if the message was enqueued.
+    '''
+    with transaction.atomic():
+        message, created = OutboxMessage.objects.get_or_create(
+            dedupe_key=dedupe_key,
+            defaults={
+                'subject': subject,
+                'body': body,
+                'to': list(to),
+                'from_email': from_email or settings.EMAIL_HOST_USER or '',
+            }
+        )
+        if created and attachments:
+            directory = posixpath.join(OUTBOX_DIR, uuid.uuid4().hex)
+            message.attachments = [
+                {
+                    'filename': filename,
+                    'path': default_storage.save(posixpath.join(directory, filename), ContentFile(content)),
+                    'mimetype': mimetype,
+                }
+                for filename, content, mimetype in attachments
+            ]
+            message.save(update_fields=['attachments'])
+    return message, created
+
+
+def delete_attachments(message):
+    '''Function deleting the copies of the attachments of a message that has been sent.'''
+    for attachment in message.attachments:
+        try:
+            default_storage.delete(attachment['path'])
+        except OSError:
+            logger.warning('Could not delete the attachment %s.', attachment['path'], exc_info=True)
+
+
+def claim_messages(batch_size):
+    '''Function claiming a batch of the messages due to be sent, by moving their next
+    attempt OUTBOX_LEASE_TIMEOUT seconds ahead. Other senders skip the claimed messages,
+    and a message is sent again if its sender died before recording the result.
+
+    Each message is claimed with a conditional UPDATE, which only matches if the message
+    is still due, so two senders running at the same time never claim the same message,
+    on any database.
+
+    Args:
+        batch_size (int): Maximum number of messages to claim.
+
+    Returns:
+        List of OutboxMessage objects.
+    '''
+    now = timezone.now()
+    lease = datetime.timedelta(seconds=getattr(settings, 'OUTBOX_LEASE_TIMEOUT', 5 * 60))
+    candidates = OutboxMessage.objects.filter(
+        status=OutboxMessage.PENDING,
+        next_attempt__lte=now
+    ).order_by('next_attempt')[:batch_size]
+    messages = []
+    for message in candidates:
+        claimed = OutboxMessage.objects.filter(
+            id=message.id,
+            status=OutboxMessage.PENDING,
+            next_attempt__lte=now
+        ).update(next_attempt=now + lease)
+        if claimed == 1:
+            message.next_attempt = now + lease
+            messages.append(message)
+    return messages
+
+
+def build_email(message, connection):
+    '''Function building the EmailMessage of an OutboxMessage, reading its attachments
+    from the storage of the media files.'''
+    email = EmailMessage(
+        subject=message.subject,
+        body=message.body,
+        from_email=message.from_email or None,
+        to=message.to,
+        connection=connection
+    )
+    for attachment in message.attachments:
+        with default_storage.open(attachment['path'], 'rb') as f:
+            email.attach(attachment['filename'], f.read(), attachment['mimetype'])
+    return email
+
+
+def record_failure(message, error):
+    '''Function scheduling the next attempt to send a message, with an exponential
+    backoff, or marking it as failed after OUTBOX_MAX_ATTEMPTS attempts.'''
+    message.attempts += 1
+    message.last_error = str(error)
+    if message.attempts >= getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 5):
+        message.status = OutboxMessage.FAILED
+    else:
+        delay = getattr(settings, 'OUTBOX_RETRY_DELAY', 60) * 2 ** (message.attempts - 1)
+        message.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
+    message.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt'])
+
+
+def send_pending_mail(batch_size=None, max_batches=None):
+    '''Function sending the messages of the outbox that are due, a batch at a time, over
+    a single SMTP connection per batch.
+
+    Args:
+        batch_size (int): Optional, the number of messages per batch. Defaults to the
+            OUTBOX_BATCH_SIZE setting.
+        max_batches (int): Optional, the maximum number of batches to send. Defaults to
+            sending until no message is due.
+
+    Returns:
+        Tuple of the number of messages sent and the number of failed attempts.
+    '''
+    batch_size = batch_size or getattr(settings, 'OUTBOX_BATCH_SIZE', 100)
+    sent = failed = batches = 0
+    while max_batches is None or batches < max_batches:
+        messages = claim_messages(batch_size)
+        if not messages:
+            break
+        batches += 1
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            logger.exception('Could not connect to the mail server.')
+            for message in messages:
+                record_failure(message, e)
+            failed += len(messages)
+            break
+        try:
+            for message in messages:
+                try:
+                    connection.send_messages([build_email(message, connection)])
+                except Exception as e:
+                    logger.warning('Could not send %s: %s', message, e)
+                    record_failure(message, e)
+                    failed += 1
+                    continue
+                message.status = OutboxMessage.SENT
+                message.sent = timezone.now()
+                message.save(update_fields=['status', 'sent'])
+                delete_attachments(message)
+                sent += 1
+        finally:
+            connection.close()
+    return sent, failed
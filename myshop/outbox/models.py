@@ -0,0 +1,52 @@
+from django.db import models
+from django.utils import timezone
+
+
+class OutboxMessage(models.Model):
+    '''Model to store the emails waiting to be sent by the send_outbox task.
+
+    Properties:
+        dedupe_key: Unique key of the message, a message enqueued again with the same key,
+            e.g. by a retried task, is not sent twice.
+        subject: Subject of the email.
+        body: Plain text body of the email.
+        from_email: Sender of the email.
+        to: List of recipients.
+        attachments: List of {'filename', 'path', 'mimetype'} dictionaries, the path
+            being the name of the copy of the attached file in the storage of the media
+            files, which is deleted once the message is sent.
+        status: Pending, sent or failed.
+        attempts: Number of failed attempts to send the message.
+        next_attempt: Datetime after which the message is sent (again).
+        last_error: Error of the last failed attempt.
+        created: Datetime the message was enqueued.
+        sent: Datetime the message was sent.
+    '''
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    dedupe_key = models.CharField(max_length=255, unique=True)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True)
+    to = models.JSONField(default=list)
+    attachments = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-created',)
+        indexes = [models.Index(fields=['status', 'next_attempt'])]
+
+    def __str__(self):
+        return self.dedupe_key
@@ -0,0 +1,12 @@
+from celery import shared_task
+from .mail import send_pending_mail
+
+
+@shared_task
+def send_outbox():
+    '''Periodic task to send the emails of the outbox that are due, see send_pending_mail.
+
+    Returns:
+        Tuple of the number of messages sent and the number of failed attempts.
+    '''
+    return send_pending_mail()
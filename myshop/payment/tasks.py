@@ -1,40 +1,38 @@
-from io import BytesIO
 from celery import shared_task
-import weasyprint
-from django.template.loader import render_to_string
-from django.core.mail import EmailMessage
-from orders.models import Order
-from django.conf import settings
+from orders.invoices import get_invoice_pdf, get_invoice_queryset
+from outbox.mail import enqueue_mail
+from outbox.models import OutboxMessage
 
 @shared_task
 def payment_completed(order_id):
-    '''Task to send an email notifaction, with a PDF invoice attachment, when an order is successfully created.
+    '''Task to enqueue an email notifaction, with a PDF invoice attachment, when an order is successfully paid.
+    The email is sent by the send_outbox task, and only enqueued once per order, so a retried task does
+    not send it twice.
     
     Args:
         order_id: The id of the order, used to retrieve the Order object.
 
     Returns:
-        None, an email is sent with a pdf attachment.
+        True if the email was enqueued, False if it had been enqueued before.
     '''
-    order = Order.objects.get(id=order_id)
+    dedupe_key = f'payment_completed:{order_id}'
+    if OutboxMessage.objects.filter(dedupe_key=dedupe_key).exists():
+        return False
+    order = get_invoice_queryset().get(id=order_id)
 
     # Create invoice email
     subject = f"Bart's Shop - Invoice no. INV{order.id}"
     message = "Please, find attached the invoice for your recent purchase."
-    email = EmailMessage(
-        subject = subject,
-        body = message,
-        from_email = settings.EMAIL_HOST_USER,
-        to = [order.email]
-        )
-    # Generate PDF
-    html = render_to_string('orders/order/pdf.html', {'order':order})
-    out = BytesIO()
-    stylesheets=[weasyprint.CSS(settings.STATIC_ROOT + 'css/pdf.css')]
-    weasyprint.HTML(string=html).write_pdf(out, stylesheets=stylesheets)
 
-    # Attach PDF File
-    email.attach(f'oroder_{order.id}.pdf', out.getvalue(), 'application/pdf')
+    # Generate and store the PDF, unless it has been stored before
+    pdf = get_invoice_pdf(order)
 
-    # Send email
-    email.send()
+    # Attach a copy of the PDF File, which is kept until the email is sent
+    _, enqueued = enqueue_mail(
+        dedupe_key=dedupe_key,
+        subject=subject,
+        body=message,
+        to=[order.email],
+        attachments=[(f'oroder_{order.id}.pdf', pdf, 'application/pdf')]
+    )
+    return enqueued
@@ -0,0 +1,508 @@
+import fnmatch
+import threading
+from collections import defaultdict
+import redis
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# The Redis clients are shared by all the Recommender instances of a process. They
+# are created on first use, so that importing this module does not require Redis.
+_client = None
+# client of the batch and maintenance work, see get_redis
+_batch_client = None
+_client_lock = threading.Lock()
+# Lua scripts registered on the clients, see run_script
+_scripts = {}
+
+
+def get_redis(batch=False):
+    '''Function returning a shared Redis client, creating it and its connection pool
+    on the first call.
+
+    The pool size, the socket timeouts and the interval of the connection health checks
+    are configured with the REDIS_MAX_CONNECTIONS, REDIS_SOCKET_TIMEOUT,
+    REDIS_SOCKET_CONNECT_TIMEOUT and REDIS_HEALTH_CHECK_INTERVAL settings. The short
+    socket timeout suits the reads of the requests, which fall back when Redis is slow.
+    The client of the batch and maintenance work, e.g. rebuilds and decays, has its own
+    pool with the longer REDIS_BATCH_SOCKET_TIMEOUT.
+
+    Args:
+        batch (bool): Optional, whether to return the client of the batch and
+            maintenance work. Defaults to False.
+
+    Returns:
+        A redis.Redis object.
+    '''
+    global _client, _batch_client
+    client = _batch_client if batch else _client
+    if client is None:
+        with _client_lock:
+            client = _batch_client if batch else _client
+            if client is None:
+                if batch:
+                    socket_timeout = getattr(settings, 'REDIS_BATCH_SOCKET_TIMEOUT', 30)
+                else:
+                    socket_timeout = getattr(settings, 'REDIS_SOCKET_TIMEOUT', 0.5)
+                pool = redis.ConnectionPool(
+                    host=settings.REDIS_HOST,
+                    port=settings.REDIS_PORT,
+                    db=settings.REDIS_DB,
+                    max_connections=getattr(settings, 'REDIS_MAX_CONNECTIONS', 50),
+                    socket_timeout=socket_timeout,
+                    socket_connect_timeout=getattr(settings, 'REDIS_SOCKET_CONNECT_TIMEOUT', 0.5),
+                    health_check_interval=getattr(settings, 'REDIS_HEALTH_CHECK_INTERVAL', 30)
+                )
+                client = redis.Redis(connection_pool=pool)
+                if batch:
+                    _batch_client = client
+                else:
+                    _client = client
+    return client
+
+
+def run_script(script, keys, args, batch=False):
+    '''Function running a Lua script, registering it on the Redis client on first use.
+
+    Args:
+        script (str): The source of the Lua script.
+        keys (list): The KEYS of the script.
+        args (list): The ARGV of the script.
+        batch (bool): Optional, whether to run the script with the client of the batch
+            and maintenance work, see get_redis. Defaults to False.
+
+    Returns:
+        The result of the script.
+    '''
+    if (script, batch) not in _scripts:
+        _scripts[script, batch] = get_redis(batch).register_script(script)
+    return _scripts[script, batch](keys=keys, args=args)
+
+
+# Lua script combining the scores of several sorted sets server-side, in a single
+# round trip and without storing the union in a temporary key.
+# KEYS: the sorted sets to combine. When ARGV[2] is 2 the keys come in pairs of
+#   (top-N list, full sorted set) per product, and the full sorted set is only read
+#   if the top-N list of the product has not been materialized yet.
+# ARGV[1]: the maximum number of members to return.
+# ARGV[2]: the number of keys per product, 1 or 2.
+# ARGV[3:]: members to exclude from the result.
+# Ties are broken in descending member order, the same order ZREVRANGE uses.
+COMBINED_SUGGESTIONS_SCRIPT = '''
+local limit = tonumber(ARGV[1])
+local stride = tonumber(ARGV[2])
+local keys = {}
+for i = 1, #KEYS, stride do
+    local key = KEYS[i]
+    if stride == 2 and redis.call('EXISTS', key) == 0 then
+        key = KEYS[i + 1]
+    end
+    keys[#keys + 1] = key
+end
+if #keys == 1 and #ARGV == 2 then
+    -- a single product without exclusions, the sorted set is already ranked
+    return redis.call('ZREVRANGE', keys[1], 0, limit - 1)
+end
+local exclude = {}
+for i = 3, #ARGV do
+    exclude[ARGV[i]] = true
+end
+local scores = {}
+for _, key in ipairs(keys) do
+    local members = redis.call('ZRANGE', key, 0, -1, 'WITHSCORES')
+    for i = 1, #members, 2 do
+        local member = members[i]
+        if not exclude[member] then
+            scores[member] = (scores[member] or 0) + tonumber(members[i + 1])
+        end
+    end
+end
+local ranked = {}
+for member, score in pairs(scores) do
+    ranked[#ranked + 1] = {member, score}
+end
+table.sort(ranked, function(a, b)
+    if a[2] == b[2] then
+        return a[1] > b[1]
+    end
+    return a[2] > b[2]
+end)
+local result = {}
+for i = 1, math.min(limit, #ranked) do
+    result[i] = ranked[i][1]
+end
+return result
+'''
+
+# Lua script multiplying every score of the given sorted sets by a decay factor,
+# removing the members whose score dropped below a minimum score and trimming the
+# sorted sets to a maximum width.
+# KEYS: the sorted sets to decay.
+# ARGV[1]: the decay factor.
+# ARGV[2]: the minimum score to keep.
+# ARGV[3]: the maximum number of members to keep, 0 to keep all of them.
+DECAY_SCRIPT = '''
+local factor = tonumber(ARGV[1])
+local width = tonumber(ARGV[3])
+for _, key in ipairs(KEYS) do
+    local members = redis.call('ZRANGE', key, 0, -1, 'WITHSCORES')
+    for i = 1, #members, 2 do
+        redis.call('ZADD', key, tonumber(members[i + 1]) * factor, members[i])
+    end
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', '(' .. ARGV[2])
+    if width > 0 then
+        redis.call('ZREMRANGEBYRANK', key, 0, -(width + 1))
+    end
+end
+return #KEYS
+'''
+
+
+class BaseBackend(object):
+    '''Interface of the storage backends of the Recommender.
+
+    The backends store sorted sets and sets under string keys, with the semantics of
+    the Redis commands of the same name. Members are returned as bytes. The Lua scripts
+    of the Redis backend are exposed as the combined_suggestions and decay methods.
+    '''
+    # exceptions raised when the backend is unavailable or too slow
+    errors = ()
+
+    def pipeline(self, transaction=False):
+        '''Return a pipeline queueing the commands until its execute method is called.
+        If transaction is True the queued commands are executed atomically.'''
+        raise NotImplementedError
+
+    def zincrby(self, name, amount, value):
+        raise NotImplementedError
+
+    def zrange(self, name, start, end, desc=False, withscores=False):
+        raise NotImplementedError
+
+    def zremrangebyrank(self, name, min, max):
+        raise NotImplementedError
+
+    def zunionstore(self, dest, keys):
+        raise NotImplementedError
+
+    def sadd(self, name, *values):
+        raise NotImplementedError
+
+    def sismember(self, name, value):
+        raise NotImplementedError
+
+    def smembers(self, name):
+        raise NotImplementedError
+
+    def spop(self, name, count=None):
+        raise NotImplementedError
+
+    def scan_iter(self, match=None, count=None):
+        raise NotImplementedError
+
+    def delete(self, *names):
+        raise NotImplementedError
+
+    def unlink(self, *names):
+        raise NotImplementedError
+
+    def ping(self):
+        raise NotImplementedError
+
+    def for_batch(self):
+        '''Return the backend to use for batch and maintenance work, e.g. rebuilds and
+        decays, which may wait longer for the storage than the reads of the requests.'''
+        return self
+
+    def combined_suggestions(self, keys, limit, stride=1, exclude=()):
+        '''Return the members with the highest combined scores of the given sorted sets.
+
+        Args:
+            keys (list): The sorted sets to combine. When stride is 2 the keys come in
+                pairs of (top-N list, full sorted set) per product, and the full sorted
+                set is only read if the top-N list does not exist.
+            limit (int): The maximum number of members to return.
+            stride (int): The number of keys per product, 1 or 2.
+            exclude (list): Members to exclude from the result.
+
+        Returns:
+            List of members, by descending combined score.
+        '''
+        raise NotImplementedError
+
+    def decay(self, keys, factor, min_score, max_width=0):
+        '''Multiply every score of the given sorted sets by factor, remove the members
+        with a score lower than min_score and trim the sorted sets to max_width members
+        (0 to keep all of them).
+
+        Returns:
+            The number of sorted sets decayed.
+        '''
+        raise NotImplementedError
+
+
+class RedisBackend(BaseBackend):
+    '''Backend storing the recommendations in Redis, see get_redis.'''
+    errors = (redis.RedisError,)
+
+    def __init__(self, batch=False):
+        '''Initialize the backend.
+
+        Args:
+            batch (bool): Optional, whether to use the client of the batch and
+                maintenance work, see get_redis. Defaults to False.
+
+        Returns:
+            None
+        '''
+        self.batch = batch
+
+    @property
+    def client(self):
+        return get_redis(self.batch)
+
+    def for_batch(self):
+        return self if self.batch else RedisBackend(batch=True)
+
+    def pipeline(self, transaction=False):
+        return self.client.pipeline(transaction=transaction)
+
+    def zincrby(self, name, amount, value):
+        return self.client.zincrby(name=name, amount=amount, value=value)
+
+    def zrange(self, name, start, end, desc=False, withscores=False):
+        return self.client.zrange(name, start, end, desc=desc, withscores=withscores)
+
+    def zremrangebyrank(self, name, min, max):
+        return self.client.zremrangebyrank(name, min, max)
+
+    def zunionstore(self, dest, keys):
+        return self.client.zunionstore(dest, keys)
+
+    def sadd(self, name, *values):
+        return self.client.sadd(name, *values)
+
+    def sismember(self, name, value):
+        return self.client.sismember(name, value)
+
+    def smembers(self, name):
+        return self.client.smembers(name)
+
+    def spop(self, name, count=None):
+        return self.client.spop(name, count)
+
+    def scan_iter(self, match=None, count=None):
+        return self.client.scan_iter(match=match, count=count)
+
+    def delete(self, *names):
+        return self.client.delete(*names)
+
+    def unlink(self, *names):
+        return self.client.unlink(*names)
+
+    def ping(self):
+        return self.client.ping()
+
+    def combined_suggestions(self, keys, limit, stride=1, exclude=()):
+        return run_script(COMBINED_SUGGESTIONS_SCRIPT, keys=keys, args=[limit, stride, *exclude], batch=self.batch)
+
+    def decay(self, keys, factor, min_score, max_width=0):
+        return run_script(DECAY_SCRIPT, keys=keys, args=[factor, min_score, max_width], batch=self.batch)
+
+
+def rank_slice(length, start, end):
+    '''Convert an inclusive Redis rank range, which may use negative ranks, to a slice.'''
+    if start < 0:
+        start = max(length + start, 0)
+    if end < 0:
+        end = length + end
+    return slice(start, max(end + 1, 0))
+
+
+def encode(value):
+    '''Encode a key or member the way the Redis client does.'''
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class InMemoryPipeline(object):
+    '''Pipeline of the InMemoryBackend, the queued commands run on execute.'''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self.backend.lock:
+            results = [method(*args, **kwargs) for method, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class InMemoryBackend(BaseBackend):
+    '''Backend storing the recommendations in the memory of the process.
+
+    It needs no external service, which makes it suitable for tests, benchmarks and
+    development, but the data is neither persistent nor shared between processes.
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # sorted sets map their members to their scores
+        self.sorted_sets = defaultdict(dict)
+        self.sets = defaultdict(set)
+
+    def ranked(self, name):
+        '''Return the (member, score) pairs of a sorted set by ascending score.'''
+        return sorted(self.sorted_sets.get(encode(name), {}).items(), key=lambda item: (item[1], item[0]))
+
+    def exists(self, name):
+        name = encode(name)
+        return bool(self.sorted_sets.get(name) or self.sets.get(name))
+
+    def pipeline(self, transaction=False):
+        return InMemoryPipeline(self)
+
+    def zincrby(self, name, amount, value):
+        with self.lock:
+            members = self.sorted_sets[encode(name)]
+            value = encode(value)
+            members[value] = members.get(value, 0) + amount
+            return members[value]
+
+    def zrange(self, name, start, end, desc=False, withscores=False):
+        with self.lock:
+            ranked = self.ranked(name)
+        if desc:
+            ranked.reverse()
+        ranked = ranked[rank_slice(len(ranked), start, end)]
+        if withscores:
+            return ranked
+        return [member for member, score in ranked]
+
+    def zremrangebyrank(self, name, min, max):
+        with self.lock:
+            ranked = self.ranked(name)
+            removed = ranked[rank_slice(len(ranked), min, max)]
+            members = self.sorted_sets[encode(name)]
+            for member, score in removed:
+                del members[member]
+            if not members:
+                del self.sorted_sets[encode(name)]
+            return len(removed)
+
+    def zunionstore(self, dest, keys):
+        with self.lock:
+            union = {}
+            for key in keys:
+                for member, score in self.sorted_sets.get(encode(key), {}).items():
+                    union[member] = union.get(member, 0) + score
+            self.sorted_sets.pop(encode(dest), None)
+            if union:
+                self.sorted_sets[encode(dest)] = union
+            return len(union)
+
+    def sadd(self, name, *values):
+        with self.lock:
+            members = self.sets[encode(name)]
+            added = {encode(value) for value in values} - members
+            members.update(added)
+            return len(added)
+
+    def sismember(self, name, value):
+        with self.lock:
+            return encode(value) in self.sets.get(encode(name), ())
+
+    def smembers(self, name):
+        with self.lock:
+            return set(self.sets.get(encode(name), ()))
+
+    def spop(self, name, count=None):
+        with self.lock:
+            members = self.sets.get(encode(name), set())
+            popped = [members.pop() for _ in range(min(count or 1, len(members)))]
+            if not members:
+                self.sets.pop(encode(name), None)
+        if count is None:
+            return popped[0] if popped else None
+        return popped
+
+    def scan_iter(self, match=None, count=None):
+        with self.lock:
+            keys = list(self.sorted_sets) + list(self.sets)
+        for key in keys:
+            if match is None or fnmatch.fnmatchcase(key.decode(), match):
+                yield key
+
+    def delete(self, *names):
+        with self.lock:
+            removed = 0
+            for name in names:
+                name = encode(name)
+                if self.sorted_sets.pop(name, None) is not None or self.sets.pop(name, None) is not None:
+                    removed += 1
+            return removed
+
+    def unlink(self, *names):
+        return self.delete(*names)
+
+    def ping(self):
+        return True
+
+    def combined_suggestions(self, keys, limit, stride=1, exclude=()):
+        with self.lock:
+            sources = []
+            for i in range(0, len(keys), stride):
+                key = keys[i]
+                if stride == 2 and not self.exists(key):
+                    key = keys[i + 1]
+                sources.append(key)
+            exclude = {encode(member) for member in exclude}
+            scores = {}
+            for key in sources:
+                for member, score in self.sorted_sets.get(encode(key), {}).items():
+                    if member not in exclude:
+                        scores[member] = scores.get(member, 0) + score
+        # ties are broken in descending member order, as in the Redis backend
+        ranked = sorted(scores.items(), key=lambda item: (item[1], item[0]), reverse=True)
+        return [member for member, score in ranked[:limit]]
+
+    def decay(self, keys, factor, min_score, max_width=0):
+        with self.lock:
+            for key in keys:
+                members = self.sorted_sets.get(encode(key))
+                if members is None:
+                    continue
+                for member, score in list(members.items()):
+                    members[member] = score * factor
+                    if members[member] < min_score:
+                        del members[member]
+                if max_width and len(members) > max_width:
+                    self.zremrangebyrank(key, 0, -(max_width + 1))
+                elif not members:
+                    del self.sorted_sets[encode(key)]
+            return len(keys)
+
+
+# The backend is shared by all the Recommender instances of a process
+_backend = None
+
+
+def get_backend():
+    '''Function returning the recommender backend of the RECOMMENDER_BACKEND setting,
+    a dotted path to a BaseBackend subclass, instantiated on the first call.'''
+    global _backend
+    if _backend is None:
+        with _client_lock:
+            if _backend is None:
+                path = getattr(settings, 'RECOMMENDER_BACKEND', 'shop.backends.RedisBackend')
+                _backend = import_string(path)()
+    return _backend
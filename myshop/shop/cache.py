@@ -0,0 +1,225 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from .backends import get_redis
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    '''Thread-safe, process-local least recently used cache with a time to live.
+
+    Entries expire after ttl seconds, which bounds how long a process can serve a
+    product that was changed by another process (the post_save signal can only
+    invalidate the cache of the process that saved the product).
+    '''
+
+    def __init__(self, max_size, ttl):
+        '''Initialize the cache.
+
+        Args:
+            max_size (int): Maximum number of entries to keep.
+            ttl (int): Number of seconds an entry stays valid.
+
+        Returns:
+            None
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        '''Return a dictionary with the values of the given keys that are in the cache.'''
+        now = time.monotonic()
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                expires, value = entry
+                if expires < now:
+                    del self.entries[key]
+                    continue
+                # mark the entry as the most recently used
+                self.entries.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, data):
+        '''Add the key-value pairs of the given dictionary to the cache.'''
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            for key, value in data.items():
+                self.entries[key] = (expires, value)
+                self.entries.move_to_end(key)
+            # evict the least recently used entries
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        '''Remove the given key from the cache.'''
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        '''Remove all the entries from the cache.'''
+        with self.lock:
+            self.entries.clear()
+
+
+local_products = LRUCache(
+    max_size=getattr(settings, 'PRODUCT_CACHE_SIZE', 1000),
+    ttl=getattr(settings, 'PRODUCT_CACHE_LOCAL_TIMEOUT', 30)
+)
+
+
+def get_product_cache_key(id):
+    '''Function to build the cache key for a product.
+
+    Args:
+        id: ID property of the Product object.
+
+    Returns:
+        Cache key for the product.
+    '''
+    return f'shop:product:{id}'
+
+
+def get_products(ids):
+    '''Retrieve the products for the given ID's, looking them up in the process-local
+    cache first, then in the Django cache and finally in the database. Products found
+    in the Django cache or in the database are added to the caches in front of them.
+
+    A changed product is only removed from the caches of the process that saved it,
+    see invalidate_product. Unless CACHES configures a cache shared by the processes,
+    the others serve the previous product, including its price and availability, for
+    up to PRODUCT_CACHE_TIMEOUT seconds.
+
+    Args:
+        ids (list): List of product ID's.
+
+    Returns:
+        Dictionary mapping the ID's to their Product objects. Products that do not
+        exist are left out.
+    '''
+    products = local_products.get_many(ids)
+    missing = [id for id in ids if id not in products]
+    if not missing:
+        return products
+
+    keys = {get_product_cache_key(id): id for id in missing}
+    shared = {keys[key]: product for key, product in cache.get_many(keys).items()}
+    local_products.set_many(shared)
+    products.update(shared)
+    missing = [id for id in missing if id not in shared]
+    if not missing:
+        return products
+
+    fetched = Product.objects.in_bulk(missing)
+    cache.set_many(
+        {get_product_cache_key(id): product for id, product in fetched.items()},
+        getattr(settings, 'PRODUCT_CACHE_TIMEOUT', 60)
+    )
+    local_products.set_many(fetched)
+    products.update(fetched)
+    return products
+
+
+def hydrate_products(ids):
+    '''Retrieve the available products for the given ID's, keeping the order of the ID's.
+
+    Args:
+        ids (list): List of product ID's, e.g. ordered by their recommendation score.
+
+    Returns:
+        List of available Product objects, in the same order as the given ID's.
+    '''
+    products = get_products(ids)
+    return [
+        products[id] for id in ids
+        if id in products and products[id].available
+    ]
+
+
+def invalidate_product(id):
+    '''Remove the product with the given ID from the process-local and Django cache of
+    the current process, and from the Django cache of the other processes if it is
+    shared by them.'''
+    local_products.delete(id)
+    cache.delete(get_product_cache_key(id))
+
+
+def get_product_version_key(id):
+    '''Function to build the cache key of the version stamp of a product.'''
+    return f'shop:product:{id}:version'
+
+
+def bump_product_version(id):
+    '''Give the product with the given ID a new version stamp, see get_product_versions.
+
+    The versions are kept in Redis, so they are shared by all the processes. If Redis is
+    unavailable the error is logged, and the carts are checked again at checkout, see
+    Cart.reconcile.
+    '''
+    try:
+        get_redis().set(get_product_version_key(id), time.time_ns())
+    except redis.RedisError:
+        logger.exception('Could not bump the version of product %s.', id)
+
+
+def get_product_versions(ids):
+    '''Return the version stamps of the given products, read from Redis with a single
+    round trip. The versions are bumped by the post_save and post_delete signals of
+    Product, so changes made with QuerySet.update() are not detected.
+
+    Products without a version, because they were never changed or their version was
+    evicted, are given a new version, so any stamp computed before is invalidated and
+    the products are checked again.
+
+    Args:
+        ids (list): List of product ID's.
+
+    Returns:
+        Dictionary mapping the ID's to their versions, or None if Redis is unavailable,
+        in which case the products must be checked.
+    '''
+    keys = [get_product_version_key(id) for id in ids]
+    try:
+        client = get_redis()
+        versions = client.mget(keys) if keys else []
+        missing = [key for key, version in zip(keys, versions) if version is None]
+        if missing:
+            with client.pipeline(transaction=False) as pipe:
+                for key in missing:
+                    # keep the version set by a concurrent request or signal, if any
+                    pipe.set(key, time.time_ns(), nx=True)
+                    pipe.get(key)
+                created = dict(zip(missing, pipe.execute()[1::2]))
+            versions = [created.get(key, version) for key, version in zip(keys, versions)]
+    except redis.RedisError:
+        logger.warning('Could not read the versions of the products.', exc_info=True)
+        return None
+    return {id: int(version) for id, version in zip(ids, versions)}
+
+
+def get_products_stamp(versions):
+    '''Return a stamp of a set of products, which changes when any of the products is
+    saved or deleted, or when the set of products changes.
+
+    Args:
+        versions (dict): Dictionary mapping product ID's to their versions, see
+            get_product_versions.
+
+    Returns:
+        String stamp of the products.
+    '''
+    stamp = ','.join(f'{id}:{version}' for id, version in sorted(versions.items()))
+    return hashlib.md5(stamp.encode()).hexdigest()
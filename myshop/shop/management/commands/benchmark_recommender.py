@@ -0,0 +1,103 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from shop.backends import InMemoryBackend
+from shop.recommender import Recommender
+
+
+def products_bought_unbatched(recommender, product_ids):
+    '''The original products_bought loop, which makes one ZINCRBY round trip per pair of products.
+
+    Args:
+        recommender: A Recommender object, used to build the product keys.
+        product_ids(list): A list of product ID's that have been bought together.
+
+    Returns:
+        The number of round trips made to Redis.
+    '''
+    round_trips = 0
+    for product_id in product_ids:
+        for with_id in product_ids:
+            if product_id != with_id:
+                recommender.backend.zincrby(
+                    name=recommender.get_product_key(product_id),
+                    amount=1,
+                    value=with_id
+                    )
+                round_trips += 1
+    return round_trips
+
+
+class Command(BaseCommand):
+    '''Management command comparing the round trips and wall time of the unbatched
+    co-purchase writes against the pipelined Recommender.products_bought_many, and
+    measuring the throughput of the suggestions of products and carts.
+
+    Synthetic product ID's are offset by --id-offset so that the benchmark does not
+    touch the scores of real products, and the keys written are deleted afterwards.
+    With --in-memory the benchmark runs against the InMemoryBackend instead of the
+    configured backend, which needs no Redis server.
+    '''
+    help = 'Benchmark the recommender co-purchase writes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=200, help='Number of orders to write.')
+        parser.add_argument('--lines', type=int, default=20, help='Number of products per order.')
+        parser.add_argument('--reads', type=int, default=1000, help='Number of suggestions to read.')
+        parser.add_argument('--catalog', type=int, default=1000, help='Number of distinct products.')
+        parser.add_argument('--in-memory', action='store_true', help='Use the in-memory backend.')
+        parser.add_argument('--id-offset', type=int, default=10**9, help='Offset for the synthetic product IDs.')
+
+    def handle(self, *args, **options):
+        recommender = Recommender(InMemoryBackend() if options['in_memory'] else None)
+        offset = options['id_offset']
+        catalog = range(offset, offset + options['catalog'])
+        lines = min(options['lines'], options['catalog'])
+        orders = [random.sample(catalog, lines) for _ in range(options['orders'])]
+
+        try:
+            start = time.perf_counter()
+            unbatched_round_trips = sum(products_bought_unbatched(recommender, ids) for ids in orders)
+            unbatched_time = time.perf_counter() - start
+            self.clear(recommender, catalog)
+
+            start = time.perf_counter()
+            per_order_round_trips = sum(recommender.products_bought_many([ids]) for ids in orders)
+            per_order_time = time.perf_counter() - start
+            self.clear(recommender, catalog)
+
+            start = time.perf_counter()
+            bulk_round_trips = recommender.products_bought_many(orders)
+            bulk_time = time.perf_counter() - start
+
+            # read the suggestions of single products and of carts of 4 products
+            reads = options['reads']
+            start = time.perf_counter()
+            for _ in range(reads):
+                ids = random.sample(catalog, 1)
+                recommender.combined_suggestions([recommender.get_product_key(id) for id in ids], 4, 1, [])
+            product_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(reads):
+                ids = random.sample(catalog, 4)
+                recommender.combined_suggestions([recommender.get_product_key(id) for id in ids], 4, 1, ids)
+            cart_time = time.perf_counter() - start
+        finally:
+            self.clear(recommender, catalog)
+
+        self.stdout.write(f'{len(orders)} orders of {lines} products')
+        self.stdout.write(f'{"method":<24}{"round trips":>12}{"seconds":>12}')
+        for name, round_trips, seconds in [
+            ('unbatched loop', unbatched_round_trips, unbatched_time),
+            ('products_bought', per_order_round_trips, per_order_time),
+            ('products_bought_many', bulk_round_trips, bulk_time),
+            ('suggestions (product)', reads, product_time),
+            ('suggestions (cart)', reads, cart_time),
+        ]:
+            self.stdout.write(f'{name:<24}{round_trips:>12}{seconds:>12.4f}')
+
+    def clear(self, recommender, catalog):
+        '''Delete the keys written for the synthetic products.'''
+        keys = [recommender.get_product_key(id) for id in catalog]
+        for i in range(0, len(keys), 1000):
+            recommender.backend.delete(*keys[i:i + 1000])
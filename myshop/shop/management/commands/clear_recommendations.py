@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from shop.recommender import Recommender
+
+
+class Command(BaseCommand):
+    '''Management command to remove all the recommendation data from Redis.'''
+    help = 'Remove all the co-purchase scores and top-N recommendation lists.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of keys removed per round trip.')
+
+    def handle(self, *args, **options):
+        removed = Recommender(batch=True).clear_purchases(
+            batch_size=options['batch_size'],
+            progress=lambda removed: self.stdout.write(f'Removed {removed} keys...')
+        )
+        self.stdout.write(self.style.SUCCESS(f'Removed {removed} keys.'))
@@ -0,0 +1,104 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.management.base import BaseCommand
+from django.db import connections
+from orders.models import Order
+from shop.recommender import Recommender
+from shop.tasks import rebuild_recommendations_chunk
+
+
+def get_chunks(orders_per_chunk):
+    '''Split the paid orders into chunks of consecutive order ID's.
+
+    The chunks are fixed ranges of orders_per_chunk order ID's, the first one starting
+    at ID 0, so the range, and the checkpoint, of a chunk do not depend on the orders
+    paid or created since a previous rebuild. Ranges without paid orders are skipped.
+
+    Args:
+        orders_per_chunk (int): The number of order ID's per chunk.
+
+    Returns:
+        Generator of (first_order_id, last_order_id) tuples.
+    '''
+    order_ids = Order.objects.filter(paid=True).order_by('id').values_list('id', flat=True)
+    previous = None
+    for order_id in order_ids.iterator(chunk_size=orders_per_chunk):
+        bucket = order_id // orders_per_chunk
+        if bucket != previous:
+            previous = bucket
+            yield bucket * orders_per_chunk, (bucket + 1) * orders_per_chunk - 1
+
+
+def get_chunk_size(chunk_ids):
+    '''Return the number of order ID's per chunk of the given checkpoints, or None if
+    there are none.'''
+    for chunk_id in chunk_ids:
+        first_order_id, last_order_id = chunk_id.split('-')
+        return int(last_order_id) - int(first_order_id) + 1
+    return None
+
+
+def rebuild_chunk(chunk):
+    '''Rebuild a chunk in a worker process, see the rebuild_recommendations_chunk task.'''
+    return rebuild_recommendations_chunk(*chunk)
+
+
+class Command(BaseCommand):
+    '''Management command to rebuild the co-purchase scores from the paid orders, e.g.
+    after the Redis data has been lost.
+
+    The paid orders are split into chunks of fixed ranges of order ID's, which are written
+    in parallel by a pool of worker processes or by Celery workers. Every chunk is
+    checkpointed in Redis once written, so an interrupted rebuild can be continued
+    with --resume. Without --resume the existing recommendations are cleared first.
+    '''
+    help = 'Rebuild the recommendations from the order history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of order IDs per chunk.')
+        parser.add_argument('--workers', type=int, default=1, help='Number of worker processes.')
+        parser.add_argument('--celery', action='store_true', help='Dispatch the chunks to the Celery workers.')
+        parser.add_argument('--resume', action='store_true', help='Skip the chunks written by a previous rebuild.')
+
+    def handle(self, *args, **options):
+        recommender = Recommender(batch=True)
+        chunk_size = options['chunk_size']
+        if options['resume']:
+            done = recommender.get_rebuilt_chunks()
+            # the chunks must have the ranges of the interrupted rebuild
+            previous_size = get_chunk_size(done)
+            if previous_size and previous_size != chunk_size:
+                self.stdout.write(self.style.WARNING(
+                    f'Resuming with the chunk size of the previous rebuild, {previous_size}.'
+                ))
+                chunk_size = previous_size
+        else:
+            recommender.clear_purchases()
+            done = set()
+        chunks = [
+            chunk for chunk in get_chunks(chunk_size)
+            if f'{chunk[0]}-{chunk[1]}' not in done
+        ]
+        self.stdout.write(f'{len(chunks)} chunks of orders to rebuild.')
+
+        if options['celery']:
+            for chunk in chunks:
+                rebuild_recommendations_chunk.delay(*chunk)
+            self.stdout.write(self.style.SUCCESS(f'Dispatched {len(chunks)} chunks to Celery.'))
+            return
+
+        if options['workers'] > 1:
+            # the worker processes must not share the database connections of this process
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                futures = [executor.submit(rebuild_chunk, chunk) for chunk in chunks]
+                for written, future in enumerate(as_completed(futures), 1):
+                    future.result()
+                    self.stdout.write(f'Rebuilt {written}/{len(chunks)} chunks...')
+        else:
+            for written, chunk in enumerate(chunks, 1):
+                rebuild_chunk(chunk)
+                self.stdout.write(f'Rebuilt {written}/{len(chunks)} chunks...')
+
+        if recommender.materialize:
+            recommender.refresh_dirty_products()
+        self.stdout.write(self.style.SUCCESS('Recommendations rebuilt.'))
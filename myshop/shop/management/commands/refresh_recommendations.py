@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from shop.models import Product
+from shop.recommender import Recommender
+
+
+class Command(BaseCommand):
+    '''Management command to materialize the top-N recommendation lists offline, e.g.
+    from cron instead of the refresh_recommendations Celery task.
+
+    By default only the products bought since the last refresh are refreshed, --all
+    rebuilds the lists of every product in the catalog.
+    '''
+    help = 'Refresh the materialized top-N recommendation lists.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Refresh the lists of all products.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of products per round trip.')
+
+    def handle(self, *args, **options):
+        recommender = Recommender(batch=True)
+        if not options['all']:
+            refreshed = recommender.refresh_dirty_products()
+        else:
+            refreshed = 0
+            batch = []
+            for id in Product.objects.values_list('id', flat=True).iterator():
+                batch.append(id)
+                if len(batch) == options['batch_size']:
+                    recommender.refresh_top_products(batch)
+                    refreshed += len(batch)
+                    batch = []
+            if batch:
+                recommender.refresh_top_products(batch)
+                refreshed += len(batch)
+        self.stdout.write(f'Refreshed the recommendations of {refreshed} products.')
@@ -1,18 +1,43 @@
-import redis
+import logging
+import time
 from django.conf import settings
-from .models import Product
+from .backends import get_backend
+from .cache import hydrate_products
 
-# Connect to Redis
-r = redis.Redis(
-    host=settings.REDIS_HOST,
-    port=settings.REDIS_PORT,
-    db=settings.REDIS_DB
-)
+logger = logging.getLogger(__name__)
+
+# time until which suggestions are not requested from the backend after a failure
+_unavailable_until = 0
+
+# Redis set of the product ID's whose top-N lists are out of date
+DIRTY_PRODUCTS_KEY = 'recommender:dirty_products'
+# Redis set of the chunks of orders already written by a rebuild from the order history
+REBUILD_CHECKPOINT_KEY = 'recommender:rebuild:done'
 
 class Recommender(object):
     '''Recommender class allowing storing of product purchases and the 
     retrieval of product suggestions for a given product or products.
+
+    The scores are stored in the backend of the RECOMMENDER_BACKEND setting,
+    see shop.backends.
     '''
+
+    def __init__(self, backend=None, batch=False):
+        '''Initialize the recommender.
+
+        Args:
+            backend: Optional, a shop.backends.BaseBackend object. Defaults to the
+                backend shared by the process.
+            batch (bool): Optional, whether the recommender is used for batch and
+                maintenance work, e.g. rebuilds and decays, which uses the longer
+                timeouts of BaseBackend.for_batch. Defaults to False.
+
+        Returns:
+            None
+        '''
+        self.backend = backend or get_backend()
+        if batch:
+            self.backend = self.backend.for_batch()
     
     def get_product_key(self, id):
         '''Function to build the Redis key for a product.
@@ -25,6 +50,65 @@ class Recommender(object):
         '''
         return f'product:{id}:purchased_with'
 
+    def get_top_products_key(self, id):
+        '''Function to build the Redis key for the materialized top-N list of a product.
+
+        Args:
+            id: ID property of the Product object.
+
+        Returns:
+            Redis key for the sorted set holding only the top RECOMMENDER_TOP_N products.
+        '''
+        return f'product:{id}:top'
+
+    @property
+    def materialize(self):
+        '''Whether the top-N lists are materialized, see the RECOMMENDER_MATERIALIZE setting.'''
+        return getattr(settings, 'RECOMMENDER_MATERIALIZE', False)
+
+    def get_product_ids(self, products):
+        '''Function to retrieve the ID's for a list of products.
+
+        Args:
+            products(list): A list of Product objects or product ID's.
+
+        Returns:
+            List of product ID's.
+        '''
+        return [getattr(p, 'id', p) for p in products]
+
+    def queue_products_bought(self, pipe, product_ids):
+        '''Method that queues the score increments for products bought together on a pipeline.
+
+        Args:
+            pipe: A backend pipeline object, the commands are only sent once it is executed.
+            product_ids(list): A list of product ID's that have been bought together.
+
+        Returns:
+            The number of commands queued on the pipeline.
+        '''
+        max_width = getattr(settings, 'RECOMMENDER_MAX_WIDTH', None)
+        queued = 0
+        for product_id in product_ids:
+            key = self.get_product_key(product_id)
+            for with_id in product_ids:
+                # get the other products bought with each product
+                if product_id != with_id:
+                    # increment score for product purchased together
+                    pipe.zincrby(name=key, amount=1, value=with_id)
+                    queued += 1
+            if max_width and len(product_ids) > 1:
+                # only keep the products with the highest scores. The sorted set may grow
+                # to twice the max_width between two decays, otherwise a product recently
+                # bought with this one would be trimmed before it can gain any score.
+                pipe.zremrangebyrank(key, 0, -(2 * max_width + 1))
+                queued += 1
+        if self.materialize and product_ids:
+            # mark the products whose top-N lists have to be refreshed
+            pipe.sadd(DIRTY_PRODUCTS_KEY, *product_ids)
+            queued += 1
+        return queued
+
     def products_bought(self, products):
         '''Method that increments the score of a given products bought togehter.
 
@@ -37,22 +121,98 @@ class Recommender(object):
             of product ID's, skipping the same product ID to retrieve the products bought together
             for each product.
         3. Use the get_product_key method to retrieve the product key for each product bought.
-        4. For each product ID contained in the sorted set, increment the score by 1.
+        4. For each product ID contained in the sorted set, queue a score increment of 1 on a
+            pipeline, which sends all the increments to Redis in a single round trip.
+        5. If the top-N lists are materialized, launch an asynchronous task to refresh the
+            lists of the products bought.
 
         Returns:
             None
         '''
-        product_ids = [p.id for p in products]
-        for product_id in product_ids:
-            for with_id in product_ids:
-                # get the other products bought with each product
-                if product_id != with_id:
-                    # increment score for product purchased together
-                    r.zincrby(
-                        name=self.get_product_key(product_id),
-                        amount=1,
-                        value=with_id
-                        )
+        self.products_bought_many([products])
+        if self.materialize:
+            # imported here, the tasks module imports the Recommender
+            from .tasks import refresh_recommendations
+            refresh_recommendations.delay()
+
+    def products_bought_many(self, orders):
+        '''Method that increments the scores for the products of many orders, e.g. for backfills.
+
+        The increments of all the orders are queued on a single pipeline, which is flushed
+        every RECOMMENDER_PIPELINE_SIZE commands to bound the memory used by large batches.
+
+        Args:
+            orders(iterable): An iterable of lists of Product objects (or product ID's), each
+                list containing the products bought together in one order.
+
+        Returns:
+            The number of round trips made to the backend.
+        '''
+        batch_size = getattr(settings, 'RECOMMENDER_PIPELINE_SIZE', 1000)
+        pipe = self.backend.pipeline(transaction=False)
+        queued = 0
+        round_trips = 0
+        for products in orders:
+            queued += self.queue_products_bought(pipe, self.get_product_ids(products))
+            if queued >= batch_size:
+                pipe.execute()
+                round_trips += 1
+                queued = 0
+        if queued:
+            pipe.execute()
+            round_trips += 1
+        return round_trips
+
+    def rebuild_chunk(self, chunk_id, orders):
+        '''Method that writes the scores of a chunk of historical orders, used to rebuild
+        the recommendations from the order history.
+
+        The increments and the checkpoint of the chunk are written in a single transaction,
+        so a chunk is either fully written or not at all, and a chunk that has already been
+        written is skipped. This allows an interrupted rebuild to be resumed.
+
+        Args:
+            chunk_id(str): Identifier of the chunk, e.g. the range of order ID's.
+            orders(iterable): An iterable of lists of product ID's bought together.
+
+        Returns:
+            True if the chunk was written, False if it had already been written.
+        '''
+        if self.backend.sismember(REBUILD_CHECKPOINT_KEY, chunk_id):
+            return False
+        pipe = self.backend.pipeline(transaction=True)
+        for product_ids in orders:
+            self.queue_products_bought(pipe, product_ids)
+        pipe.sadd(REBUILD_CHECKPOINT_KEY, chunk_id)
+        pipe.execute()
+        return True
+
+    def get_rebuilt_chunks(self):
+        '''Method that returns the set of chunk identifiers written by the current rebuild.'''
+        return {chunk_id.decode() for chunk_id in self.backend.smembers(REBUILD_CHECKPOINT_KEY)}
+
+    def combined_suggestions(self, keys, limit, stride, exclude):
+        '''Method that gets the suggested product ID's from the backend, falling back to
+        no suggestions when the backend fails or is slower than the socket timeout.
+
+        After a failure the backend is not asked for suggestions for REDIS_RETRY_INTERVAL
+        seconds, so that an outage does not add the socket timeout to every page rendered.
+
+        Args:
+            See shop.backends.BaseBackend.combined_suggestions.
+
+        Returns:
+            List of the suggested product ID's, empty if the backend is unavailable.
+        '''
+        global _unavailable_until
+        if time.monotonic() < _unavailable_until:
+            return []
+        try:
+            return self.backend.combined_suggestions(keys, limit, stride, exclude)
+        except self.backend.errors:
+            logger.warning('The recommender backend is unavailable, no product suggestions returned.', exc_info=True)
+            _unavailable_until = time.monotonic() + getattr(settings, 'REDIS_RETRY_INTERVAL', 5)
+            return []
 
     def suggest_products_for(self, products, max_results=6):
         '''Method that returns a sorted list of product objects bought together with the
@@ -67,40 +227,134 @@ class Recommender(object):
                 recommendations to return.
 
         Returns:
-            Sorted list of Product objects bought together with the given list of products.
+            Sorted list of Product objects bought together with the given list of products,
+            or an empty list if the backend is unavailable.
         '''
         product_ids = [p.id for p in products]
-        if len(products) == 1:
-            # only 1 product
-            suggestions = r.zrange(
-                self.get_product_key(product_ids[0]),
-                0,
-                -1,
-                desc=True
-            )[:max_results]
-        else:
-            # generate a temporary key
-            flat_ids = ''.join([str(id) for id in product_ids])
-            tmp_key = f'tmp_{flat_ids}'
-            # multiple products, combine scores of all products
-            # store the resulting sorted set in a temporary key
-            keys = [self.get_product_key(id) for id in product_ids]
-            r.zunionstore(tmp_key, keys)
-            # remove ids for the products the recommendation is for
-            r.zrem(tmp_key, *product_ids)
-            # get the product ids by their score, descendant sort
-            suggestions = r.zrange(tmp_key, 0, -1, desc=True)[:max_results]
-            # remove the temporary key
-            r.delete(tmp_key)
+        if not product_ids or max_results <= 0:
+            return []
+        # combine scores of all products, excluding the ids of the products the
+        # recommendation is for when there are several, atomically in a single call
+        keys = []
+        for id in product_ids:
+            if self.materialize:
+                # read the small top-N list, falling back to the full sorted set
+                keys.append(self.get_top_products_key(id))
+            keys.append(self.get_product_key(id))
+        excluded = product_ids if len(product_ids) > 1 else []
+        stride = 2 if self.materialize else 1
+        suggestions = self.combined_suggestions(keys, max_results, stride, excluded)
         suggested_products_ids = [int(id) for id in suggestions]
-        # get suggested products and sort by order of appearance
-        suggested_products = list(Product.objects.filter(id__in=suggested_products_ids))
-        suggested_products.sort(key=lambda x: suggested_products_ids.index(x.id))
-        return suggested_products
+        # get the available suggested products, in the order of their scores
+        return hydrate_products(suggested_products_ids)
+
+    def refresh_top_products(self, product_ids):
+        '''Method that materializes the top-N lists for the given products.
+
+        The full sorted set of each product is copied and trimmed to its
+        RECOMMENDER_TOP_N highest scores inside a transaction, so readers never
+        see a partially built list. Products without purchases lose their list.
+
+        Args:
+            product_ids(list): A list of product ID's to refresh.
+
+        Returns:
+            None
+        '''
+        top_n = getattr(settings, 'RECOMMENDER_TOP_N', 10)
+        pipe = self.backend.pipeline(transaction=True)
+        for id in product_ids:
+            top_key = self.get_top_products_key(id)
+            pipe.zunionstore(top_key, [self.get_product_key(id)])
+            pipe.zremrangebyrank(top_key, 0, -(top_n + 1))
+        pipe.execute()
+
+    def refresh_dirty_products(self):
+        '''Method that refreshes the top-N lists of the products bought since the last refresh.
+
+        Returns:
+            The number of products refreshed.
+        '''
+        batch_size = getattr(settings, 'RECOMMENDER_PIPELINE_SIZE', 1000) // 2
+        refreshed = 0
+        while True:
+            product_ids = self.backend.spop(DIRTY_PRODUCTS_KEY, batch_size)
+            if not product_ids:
+                return refreshed
+            self.refresh_top_products([int(id) for id in product_ids])
+            refreshed += len(product_ids)
+
+
+    def scan_keys(self, pattern, batch_size=1000):
+        '''Method that walks the keys matching a pattern with SCAN, without blocking Redis.
+
+        Args:
+            pattern(str): The glob-style pattern of the keys.
+            batch_size(int): The number of keys per batch, also used as the SCAN count hint.
+
+        Returns:
+            Generator of lists with at most batch_size keys.
+        '''
+        batch = []
+        for key in self.backend.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
+    def scan_product_keys(self, batch_size=1000):
+        '''Method that walks the product sorted sets with SCAN, see scan_keys.'''
+        return self.scan_keys(self.get_product_key('*'), batch_size)
 
-    def clear_purchases(self):
-        '''Method to clear recommendations.'''
-        for id in Product.objects.values_list('id', flat=True):
-            r.delete(self.get_product_key(id))
+    def decay_purchases(self, factor=None, min_score=None, batch_size=100):
+        '''Method that multiplies all the scores by a decay factor, so that recent purchases
+        weigh more than old ones, removes the products whose score dropped below a
+        minimum score and trims the sorted sets to RECOMMENDER_MAX_WIDTH products.
+        If the top-N lists are materialized they are refreshed as well.
 
+        Args:
+            factor(float): The decay factor, defaults to RECOMMENDER_DECAY_FACTOR.
+            min_score(float): The minimum score to keep, defaults to RECOMMENDER_DECAY_MIN_SCORE.
+            batch_size(int): The number of sorted sets decayed per call to Redis.
+
+        Returns:
+            The number of sorted sets decayed.
+        '''
+        if factor is None:
+            factor = getattr(settings, 'RECOMMENDER_DECAY_FACTOR', 0.95)
+        if min_score is None:
+            min_score = getattr(settings, 'RECOMMENDER_DECAY_MIN_SCORE', 0.1)
+        max_width = getattr(settings, 'RECOMMENDER_MAX_WIDTH', None) or 0
+        decayed = 0
+        for keys in self.scan_product_keys(batch_size):
+            decayed += self.backend.decay(keys, factor, min_score, max_width)
+            if self.materialize:
+                self.refresh_top_products([int(key.split(b':')[1]) for key in keys])
+        return decayed
+
+    def clear_purchases(self, batch_size=1000, progress=None):
+        '''Method to clear recommendations.
+
+        The product sorted sets and top-N lists are found with SCAN, which also covers
+        the keys of products deleted from the database, and removed with UNLINK, which
+        reclaims the memory in a background thread so that Redis is not blocked.
+
+        Args:
+            batch_size(int): The number of keys unlinked per round trip.
+            progress: Optional callable, called with the number of keys removed so far
+                after every batch.
+
+        Returns:
+            The number of keys removed.
+        '''
+        removed = 0
+        patterns = [self.get_product_key('*'), self.get_top_products_key('*')]
+        for pattern in patterns:
+            for keys in self.scan_keys(pattern, batch_size):
+                removed += self.backend.unlink(*keys)
+                if progress:
+                    progress(removed)
+        self.backend.unlink(DIRTY_PRODUCTS_KEY, REBUILD_CHECKPOINT_KEY)
+        return removed
@@ -0,0 +1,17 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Product
+from .cache import invalidate_product, bump_product_version
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, instance, **kwargs):
+    '''Invalidate the cached copy of a product when it is saved or deleted, and give it a
+    new version stamp so that the carts containing it are reconciled again. The version
+    is bumped once the change is committed, so a cart cannot be stamped with the new
+    version while it still reads the previous product.'''
+    invalidate_product(instance.id)
+    product_id = instance.id
+    transaction.on_commit(lambda: bump_product_version(product_id))
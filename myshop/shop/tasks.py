@@ -0,0 +1,73 @@
+from itertools import groupby
+from celery import shared_task
+from orders.models import OrderItem
+from .recommender import Recommender
+
+
+@shared_task
+def refresh_recommendations():
+    '''Task to refresh the materialized top-N recommendation lists of the products
+    bought since the last refresh.
+
+    Returns:
+        The number of products refreshed.
+    '''
+    return Recommender(batch=True).refresh_dirty_products()
+
+
+@shared_task
+def decay_recommendations():
+    '''Periodic task to decay the co-purchase scores, see Recommender.decay_purchases.
+
+    Returns:
+        The number of sorted sets decayed.
+    '''
+    return Recommender(batch=True).decay_purchases()
+
+
+@shared_task
+def clear_recommendations():
+    '''Task to remove all the recommendation data, see Recommender.clear_purchases.
+
+    Returns:
+        The number of keys removed.
+    '''
+    return Recommender(batch=True).clear_purchases()
+
+
+def iter_paid_orders(first_order_id, last_order_id, chunk_size=2000):
+    '''Stream the products of the paid orders within a range of order ID's.
+
+    Args:
+        first_order_id: The first order ID of the range.
+        last_order_id: The last order ID of the range, inclusive.
+        chunk_size: The number of rows fetched from the database at a time.
+
+    Returns:
+        Generator of lists with the product ID's bought together in each order.
+    '''
+    items = OrderItem.objects.filter(
+        order__paid=True,
+        order_id__gte=first_order_id,
+        order_id__lte=last_order_id
+    ).order_by('order_id').values_list('order_id', 'product_id')
+    for order_id, rows in groupby(items.iterator(chunk_size=chunk_size), key=lambda row: row[0]):
+        yield [product_id for _, product_id in rows]
+
+
+@shared_task
+def rebuild_recommendations_chunk(first_order_id, last_order_id):
+    '''Task to rebuild the co-purchase scores from the paid orders within a range of
+    order ID's, see the rebuild_recommendations management command.
+
+    Args:
+        first_order_id: The first order ID of the range.
+        last_order_id: The last order ID of the range, inclusive.
+
+    Returns:
+        True if the chunk was written, False if it had already been written.
+    '''
+    return Recommender(batch=True).rebuild_chunk(
+        f'{first_order_id}-{last_order_id}',
+        iter_paid_orders(first_order_id, last_order_id)
+    )
@@ -1,3 +1,147 @@
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
+from orders.models import Order, OrderItem
+from .backends import InMemoryBackend
+from .cache import local_products
+from .models import Category, Product
+from .recommender import Recommender
 
-# Create your tests here.
+
+class InMemoryRecommenderTests(TestCase):
+    '''Tests of the Recommender with the InMemoryBackend, which need no Redis server.'''
+
+    def setUp(self):
+        # the product caches outlive the test transactions
+        local_products.clear()
+        cache.clear()
+        category = Category.objects.create(name='Tea', slug='tea')
+        self.green, self.black, self.white, self.oolong = [
+            Product.objects.create(category=category, name=name, slug=name.lower().replace(' ', '-'), price=Decimal('10.00'))
+            for name in ['Green tea', 'Black tea', 'White tea', 'Oolong tea']
+        ]
+        self.backend = InMemoryBackend()
+        self.recommender = Recommender(self.backend)
+
+    def test_products_bought(self):
+        self.recommender.products_bought([self.green, self.black, self.white])
+        self.assertEqual(
+            dict(self.backend.zrange(self.recommender.get_product_key(self.green.id), 0, -1, withscores=True)),
+            {str(self.black.id).encode(): 1, str(self.white.id).encode(): 1}
+        )
+
+    def test_suggest_products_for_one_product(self):
+        self.recommender.products_bought([self.green, self.black])
+        self.recommender.products_bought([self.green, self.black, self.white])
+        self.recommender.products_bought([self.green, self.oolong])
+        self.recommender.products_bought([self.green, self.black])
+        suggestions = self.recommender.suggest_products_for([self.green])
+        self.assertEqual(suggestions[0], self.black)
+        self.assertEqual(set(suggestions[1:]), {self.white, self.oolong})
+
+    def test_suggest_products_for_several_products(self):
+        self.recommender.products_bought([self.green, self.white])
+        self.recommender.products_bought([self.black, self.white])
+        self.recommender.products_bought([self.black, self.oolong])
+        self.recommender.products_bought([self.green, self.black])
+        suggestions = self.recommender.suggest_products_for([self.green, self.black])
+        # the products the suggestions are for are excluded
+        self.assertEqual(suggestions, [self.white, self.oolong])
+
+    def test_suggest_products_for_max_results(self):
+        self.recommender.products_bought([self.green, self.black])
+        self.recommender.products_bought([self.green, self.black, self.white])
+        self.assertEqual(self.recommender.suggest_products_for([self.green], max_results=1), [self.black])
+
+    def test_unavailable_products_are_not_suggested(self):
+        self.recommender.products_bought([self.green, self.black, self.white])
+        self.black.available = False
+        self.black.save()
+        self.assertEqual(self.recommender.suggest_products_for([self.green]), [self.white])
+
+    def test_no_purchases(self):
+        self.assertEqual(self.recommender.suggest_products_for([self.green]), [])
+
+    def test_products_bought_many(self):
+        orders = [[self.green, self.black], [self.green.id, self.white.id], [self.green, self.black]]
+        self.assertEqual(self.recommender.products_bought_many(orders), 1)
+        self.assertEqual(self.recommender.suggest_products_for([self.green]), [self.black, self.white])
+
+    def test_decay_purchases(self):
+        self.recommender.products_bought([self.green, self.black])
+        self.recommender.products_bought([self.green, self.black])
+        self.recommender.products_bought([self.green, self.white])
+        self.recommender.decay_purchases(factor=0.5, min_score=0.75)
+        # the score of the white tea dropped below the minimum score
+        self.assertEqual(self.recommender.suggest_products_for([self.green]), [self.black])
+
+    def test_clear_purchases(self):
+        self.recommender.products_bought([self.green, self.black, self.white])
+        self.assertEqual(self.recommender.clear_purchases(), 3)
+        self.assertEqual(self.recommender.suggest_products_for([self.green]), [])
+
+
+class RebuildRecommendationsTests(TestCase):
+    '''Tests of the rebuild_recommendations management command, with the InMemoryBackend.'''
+
+    def setUp(self):
+        self.backend = InMemoryBackend()
+        patcher = mock.patch('shop.backends._backend', self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        category = Category.objects.create(name='Tea', slug='tea')
+        self.green, self.black = [
+            Product.objects.create(category=category, name=name, slug=name.lower().replace(' ', '-'), price=Decimal('10.00'))
+            for name in ['Green tea', 'Black tea']
+        ]
+        self.recommender = Recommender(self.backend)
+
+    def create_order(self, paid=True):
+        order = Order.objects.create(
+            first_name='Ada',
+            last_name='Lovelace',
+            email='ada@example.com',
+            address='12 St James Square',
+            postal_code='SW1Y 4JH',
+            city='London',
+            paid=paid
+        )
+        for product in [self.green, self.black]:
+            OrderItem.objects.create(order=order, product=product, price=product.price, quantity=1)
+        return order
+
+    def get_score(self):
+        scores = dict(self.backend.zrange(self.recommender.get_product_key(self.green.id), 0, -1, withscores=True))
+        return scores.get(str(self.black.id).encode(), 0)
+
+    def rebuild(self, *args):
+        call_command('rebuild_recommendations', *args, stdout=StringIO())
+
+    def test_rebuild(self):
+        for _ in range(6):
+            self.create_order()
+        self.create_order(paid=False)
+        self.rebuild('--chunk-size', '4')
+        self.assertEqual(self.get_score(), 6)
+
+    def test_resume_after_an_order_is_paid(self):
+        for _ in range(6):
+            self.create_order()
+        unpaid = self.create_order(paid=False)
+        self.rebuild('--chunk-size', '4')
+        unpaid.paid = True
+        unpaid.save()
+        self.create_order()
+        # the chunks already written are skipped, the new order is in a new chunk
+        self.rebuild('--chunk-size', '4', '--resume')
+        self.assertEqual(self.get_score(), 7)
+
+    def test_resume_with_another_chunk_size(self):
+        for _ in range(6):
+            self.create_order()
+        self.rebuild('--chunk-size', '4')
+        self.rebuild('--chunk-size', '3', '--resume')
+        self.assertEqual(self.get_score(), 6)